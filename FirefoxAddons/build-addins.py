@@ -0,0 +1,173 @@
+"""Script to build the xpi add-ins for firefox
+Builds each sub folder containing an install.rdf, all in parallel.
+The entries unchanged since the previous xpi are copied without recompression.
+Usage : python build-addins.py "x.x.x.x"
+"""
+
+import os, re, sys, datetime, zipfile, zlib, threading, tempfile
+
+CD = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.dirname(CD))
+from ziputils import copy_member
+
+OUT_DIR = os.path.join(CD, 'bin')
+
+#xpi name of the add-ins not named after their folder
+XPI_NAMES = {
+    'vb-format': 'vb-formatters.xpi'
+}
+
+def main(args):
+    arg_version = args and args[0]
+    set_working_dir(CD)
+
+    addins = find_addins(CD)
+
+    print __doc__
+    for addin in addins:
+        print '%-16s : %s (%s)' % (addin.name, addin.get_version(), addin.get_mtime('%Y-%m-%d %H:%M:%S') or 'none')
+
+    new_version = arg_version or get_input_version(addins[0].get_version())
+
+    print 'New version : ' + new_version + '\n'
+    make_dir(OUT_DIR)
+
+    threads = [threading.Thread(target=addin.build, args=(new_version,)) for addin in addins]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for addin in addins:
+        if addin.error:
+            raise addin.error[0], addin.error[1], addin.error[2]
+        print '%-16s : %d copied, %d compressed' % (addin.xpi_name, addin.copied, addin.compressed)
+
+    print '\nDone'
+
+
+def find_addins(directory):
+    addins = []
+    for name in sorted(os.listdir(directory)):
+        if os.path.isfile(os.path.join(directory, name, 'install.rdf')):
+            addins.append(Addin(name, os.path.join(directory, name)))
+    return addins
+
+class Addin:
+    """Firefox add-in built from a folder to an xpi in OUT_DIR.
+    The version number is only updated in the xpi, not in the source install.rdf.
+    """
+
+    def __init__(self, name, src_dir):
+        self.name = name
+        self.src_dir = src_dir
+        self.xpi_name = XPI_NAMES.get(name, name + '.xpi')
+        self.xpi_path = os.path.join(OUT_DIR, self.xpi_name)
+        self.copied = 0
+        self.compressed = 0
+        self.error = None
+
+    def get_version(self):
+        try:
+            with zipfile.ZipFile(self.xpi_path, 'r') as zip:
+                text = zip.read('install.rdf')
+        except (IOError, KeyError, zipfile.BadZipfile):
+            with open(os.path.join(self.src_dir, 'install.rdf'), 'rb') as f:
+                text = f.read()
+        return re.search(r'version>([.\d]+)<', text).group(1)
+
+    def get_mtime(self, format=None):
+        return get_file_mtime(self.xpi_path, format)
+
+    def build(self, version):
+        try:
+            self.write(version)
+        except:
+            self.error = sys.exc_info()
+
+    def write(self, version):
+        previous = None
+        if os.path.isfile(self.xpi_path):
+            try:
+                previous = zipfile.ZipFile(self.xpi_path, 'r')
+            except zipfile.BadZipfile:
+                pass
+        fd, tmp_path = tempfile.mkstemp(suffix='.xpi', dir=OUT_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zip:
+                    for arcname, path in self.list_files():
+                        with open(path, 'rb') as src:
+                            data = src.read()
+                        if arcname == 'install.rdf':
+                            data = re.sub(r'(?<=version>)[.\d]+(?=<)', version, data)
+                        info = previous and find_member(previous, arcname)
+                        if info and info.file_size == len(data) \
+                            and info.CRC == zlib.crc32(data) & 0xffffffff:
+                            copy_member(previous, info, zip)
+                            self.copied += 1
+                        else:
+                            zinfo = zipfile.ZipInfo(arcname, get_file_mtime(path).timetuple()[:6])
+                            zinfo.compress_type = zipfile.ZIP_DEFLATED
+                            zinfo.external_attr = 0644 << 16
+                            zip.writestr(zinfo, data)
+                            self.compressed += 1
+        except:
+            os.remove(tmp_path)
+            raise
+        finally:
+            if previous:
+                previous.close()
+        replace_file(tmp_path, self.xpi_path)
+
+    def list_files(self):
+        for root, dirs, files in os.walk(self.src_dir):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, self.src_dir).replace(os.sep, '/'), path
+
+def find_member(zip, name):
+    try:
+        return zip.getinfo(name)
+    except KeyError:
+        return None
+
+def replace_file(src, dest):
+    if os.path.isfile(dest):
+        os.remove(dest)
+    os.rename(src, dest)
+
+def set_working_dir(directory):
+    make_dir(directory)
+    os.chdir(directory)
+
+def make_dir(directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+def get_file_mtime(filepath, format=None):
+    if(not os.path.isfile(filepath)):
+        return None
+    dt = datetime.datetime.fromtimestamp(os.path.getmtime(filepath))
+    if format:
+        return dt.strftime(format)
+    return dt
+
+def get_input(message):
+    try: return raw_input(message)
+    except NameError: return input(message)
+
+def get_input_version(version):
+    while True:
+        input = get_input('Digit to increment [w.x.y.z] or version [0.0.0.0] or skip [s] ? ').strip()
+        if re.match(r's|w|x|y|z', input) :
+            idx = {'s': 99, 'w': 0, 'x': 1, 'y': 2, 'z': 3}[input]
+            return '.'.join([str((int(v)+(i == idx))*(i <= idx)) for i, v in enumerate(version.split('.'))])
+        elif re.match(r'\d+\.\d+\.\d+\.\d+', input):
+            return input
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
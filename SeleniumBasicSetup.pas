@@ -1,5 +1,5 @@
 {
- Code generated at each build by gen-registration.ipy
+ Code generated at each build by gen-registration.py
  This is a subset of SeleniumBasicSetup.iss
 }
 
@@ -7,22 +7,29 @@
  Creates the setup installer with InnoSetup [http://www.jrsoftware.org/isinfo.php]
 """
 
-import os, re, time, sys, traceback, shutil, datetime, subprocess, zipfile, glob
+import os, re, time, sys, traceback, shutil, datetime, subprocess, zipfile, glob, fnmatch, threading, argparse, multiprocessing, hashlib, json, collections, ctypes, signal
+from tracing import Trace
 
 __dir__ = os.path.dirname(os.path.realpath(__file__))
 
-APP_MSBUILD_PATH = r'c:\WINDOWS\Microsoft.NET\Framework\v4.0.30319\MSBuild.exe'
-APP_TLBEXP_PATH = r'c:\Progra~2\Microsoft SDKs\Windows\v8.1A\bin\NETFX 4.5.1 Tools\TlbExp.exe'
-APP_INNOSETUP_PATH = r'c:\Progra~2\Inno Setup 5\ISCC.exe'
-APP_PYTHON_PATH = r'c:\Progra~2\Python27\python.exe'
-APP_IRONPYTHON_PATH = r'c:\Progra~2\IronPython 2.7\ipy.exe'
-APP_SHFBROOT_DIR = r'c:\Progra~2\EWSoftware\Sandcastle Help File Builder'
+APP_MSBUILD_PATH = os.environ.get('APP_MSBUILD_PATH', r'c:\WINDOWS\Microsoft.NET\Framework\v4.0.30319\MSBuild.exe')
+APP_TLBEXP_PATH = os.environ.get('APP_TLBEXP_PATH', r'c:\Progra~2\Microsoft SDKs\Windows\v8.1A\bin\NETFX 4.5.1 Tools\TlbExp.exe')
+APP_INNOSETUP_PATH = os.environ.get('APP_INNOSETUP_PATH', r'c:\Progra~2\Inno Setup 5\ISCC.exe')
+APP_PYTHON_PATH = os.environ.get('APP_PYTHON_PATH', r'c:\Progra~2\Python27\python.exe')
+APP_SHFBROOT_DIR = os.environ.get('APP_SHFBROOT_DIR', r'c:\Progra~2\EWSoftware\Sandcastle Help File Builder')
 
-def main():
+def main(args):
+    parser = argparse.ArgumentParser(description='Create the installation package')
+    parser.add_argument('--version', help='New version [0.0.0.0], asked if missing')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='Number of steps run in parallel')
+    parser.add_argument('--no-install', action='store_true', help='Do not launch the setup once built')
+    parser.add_argument('--force', action='store_true', help='Rebuild all the steps')
+    options = parser.parse_args(args)
+    
     set_working_dir(__dir__)
     check_globals_exists(r'_PATH$|_DIR$')
     
-    assemblyinfo_path = __dir__ + r'\Selenium\Properties\AssemblyInfo.cs'
+    assemblyinfo_path = os.path.join(__dir__, 'Selenium', 'Properties', 'AssemblyInfo.cs')
     last_modified_time = get_file_mtime(assemblyinfo_path, '%Y-%m-%d %H:%M:%S')
     current_version = match_in_file(assemblyinfo_path, r'AssemblyFileVersion\("([.\d]+)"\)')
     
@@ -31,74 +38,124 @@ def main():
     print 'Current Version  : ' + current_version
     print ''
     
-    new_version = get_input_version(current_version)
+    new_version = options.version or get_input_version(current_version)
 
     print 'New version : ' + new_version + '\n'
     print 'Update version number ...'
     replace_in_file(assemblyinfo_path, r'Version\("[.\d]+"\)', r'Version("{}")'.format(new_version))
 
-    print 'Delete previous builds ...'
-    clear_dir(r'.\FirefoxAddons\bin')
-    clear_dir(r'.\Selenium\bin\Release')
-    clear_dir(r'.\Selenium\obj\Release')
-    clear_dir(r'.\Selenium\bin\Help')
-    clear_dir(r'.\VbsConsole\bin\Release')
-    clear_dir(r'.\VbsConsole\obj\Release')
-    
-    print 'Build vb-format addin ...'
-    execute(APP_IRONPYTHON_PATH, __dir__ + r'\FirefoxAddons\build-vb-format.py', current_version)
-    
-    print 'Build implicit-wait addin ...'
-    execute(APP_IRONPYTHON_PATH, __dir__ + r'\FirefoxAddons\build-implicit-wait.py', current_version)
-    
-    print 'Build extensions package ...'
-    with zipfile.ZipFile(__dir__ + r'\FirefoxAddons\bin\extensions.xpi', 'a') as zip:
-        zip.write(__dir__ + r'\FirefoxAddons\install.rdf', 'install.rdf')
-        zip.write(__dir__ + r'\References\selenium-ide.xpi', 'selenium-ide.xpi')
-        zip.write(__dir__ + r'\FirefoxAddons\bin\vb-formatters.xpi', 'vb-formatters.xpi')
-        zip.write(__dir__ + r'\FirefoxAddons\bin\implicit-wait.xpi', 'implicit-wait.xpi')
-    
-    print 'Build .Net library ...'
-    execute(APP_MSBUILD_PATH, '/t:build', '/nologo', '/v:quiet',
-        r'/p:Configuration=Release;TargetFrameworkVersion=v3.5',
-        r'/p:RegisterForComInterop=False',
-        r'/p:SignAssembly=true;AssemblyOriginatorKeyFile=key.snk', 
-        r'.\Selenium\Selenium.csproj' )
-    
-    print 'Build Type libraries 32bits ...'
-    execute(APP_TLBEXP_PATH, r'.\Selenium\bin\Release\Selenium.dll', 
-        r'/win32', r'/out:.\Selenium\bin\Release\Selenium32.tlb' )
-    
-    print 'Build Type libraries 64bits ...'
-    execute(APP_TLBEXP_PATH,
-        r'.\Selenium\bin\Release\Selenium.dll', 
-        r'/win64', r'/out:.\Selenium\bin\Release\Selenium64.tlb' )
-    
-    print 'Build console runner ...'
-    execute(APP_MSBUILD_PATH, '/v:quiet', '/t:build', '/nologo', 
-        r'/p:Configuration=Release;TargetFrameworkVersion=v3.5', 
-        r'.\VbsConsole\VbsConsole.csproj' )
-    
-    print 'Build documentation ...'
+    manifest = BuildManifest(re.sub(r'\.[^.]+$', '.manifest.json', __file__))
+    if options.force:
+        print 'Delete previous builds ...'
+        manifest.clear()
+        clear_dir(os.path.join('FirefoxAddons', 'bin'))
+        clear_dir(os.path.join('Selenium', 'bin', 'Release'))
+        clear_dir(os.path.join('Selenium', 'obj', 'Release'))
+        clear_dir(os.path.join('Selenium', 'bin', 'Help'))
+        clear_dir(os.path.join('VbsConsole', 'bin', 'Release'))
+        clear_dir(os.path.join('VbsConsole', 'obj', 'Release'))
+    
     os.environ['SHFBROOT'] = APP_SHFBROOT_DIR
-    execute(APP_MSBUILD_PATH, '/p:Configuration=Release', '/nologo', '.\Selenium\Selenium.shfbproj')
     
-    print 'Build registration file ...'
-    execute(APP_IRONPYTHON_PATH, r'gen-registration.ipy', \
-        r'Selenium\bin\Release\Selenium.dll', __dir__ + r'\SeleniumBasicSetup.pas')
+    #each step runs as soon as the steps producing its inputs are done
+    #and is skipped if its inputs and outputs are the same as in the last build
+    run_steps(options.jobs, manifest, [
     
-    print 'Rebuild excel files ...'
-    execute(APP_PYTHON_PATH, __dir__ + r'\rebuild_exel_files.py')
+        Step('Build firefox addins',
+            [r'FirefoxAddons\vb-format\*', r'FirefoxAddons\implicit-wait\*', r'FirefoxAddons\build-addins.py'],
+            [r'FirefoxAddons\bin\vb-formatters.xpi', r'FirefoxAddons\bin\implicit-wait.xpi'],
+            execute, APP_PYTHON_PATH, os.path.join(__dir__, 'FirefoxAddons', 'build-addins.py'), current_version,
+            keep=True),
+        
+        Step('Build extensions package',
+            [r'FirefoxAddons\install.rdf', r'References\selenium-ide.xpi',
+             r'FirefoxAddons\bin\vb-formatters.xpi', r'FirefoxAddons\bin\implicit-wait.xpi'],
+            [r'FirefoxAddons\bin\extensions.xpi'],
+            build_extensions_package),
+        
+        Step('Build .Net library',
+            [r'Selenium\*.cs', r'Selenium\Selenium.csproj', r'References\*.dll'],
+            [r'Selenium\bin\Release\Selenium.dll', r'Selenium\bin\Release\Selenium.pdb',
+             r'Selenium\bin\Release\Selenium.xml'],
+            execute, APP_MSBUILD_PATH, '/t:build', '/nologo', '/v:quiet',
+                r'/p:Configuration=Release;TargetFrameworkVersion=v3.5',
+                r'/p:RegisterForComInterop=False',
+                r'/p:SignAssembly=true;AssemblyOriginatorKeyFile=key.snk',
+                os.path.join('.', 'Selenium', 'Selenium.csproj'),
+            clear=[r'Selenium\bin\Release', r'Selenium\obj\Release']),
+        
+        Step('Build Type libraries 32bits',
+            [r'Selenium\bin\Release\Selenium.dll'],
+            [r'Selenium\bin\Release\Selenium32.tlb'],
+            execute, APP_TLBEXP_PATH, os.path.join('.', 'Selenium', 'bin', 'Release', 'Selenium.dll'),
+                r'/win32', '/out:' + os.path.join('.', 'Selenium', 'bin', 'Release', 'Selenium32.tlb')),
+        
+        Step('Build Type libraries 64bits',
+            [r'Selenium\bin\Release\Selenium.dll'],
+            [r'Selenium\bin\Release\Selenium64.tlb'],
+            execute, APP_TLBEXP_PATH, os.path.join('.', 'Selenium', 'bin', 'Release', 'Selenium.dll'),
+                r'/win64', '/out:' + os.path.join('.', 'Selenium', 'bin', 'Release', 'Selenium64.tlb')),
+        
+        Step('Build console runner',
+            [r'VbsConsole\*', r'Selenium\bin\Release\Selenium.dll'],
+            [r'VbsConsole\bin\Release\vbsc.exe'],
+            execute, APP_MSBUILD_PATH, '/v:quiet', '/t:build', '/nologo',
+                r'/p:Configuration=Release;TargetFrameworkVersion=v3.5',
+                os.path.join('.', 'VbsConsole', 'VbsConsole.csproj'),
+            clear=[r'VbsConsole\bin\Release', r'VbsConsole\obj\Release'],
+            rewrites=[r'Selenium\bin\Release\*']),  #builds the referenced Selenium project
+        
+        Step('Build documentation',
+            [r'Selenium\Selenium.shfbproj', r'Selenium\bin\Release\Selenium.dll',
+             r'Selenium\bin\Release\Selenium.xml'],
+            [r'Selenium\bin\Help\Selenium.chm'],
+            execute, APP_MSBUILD_PATH, '/p:Configuration=Release', '/nologo',
+                os.path.join('.', 'Selenium', 'Selenium.shfbproj'),
+            clear=[r'Selenium\bin\Help'], timeout=3600),
+        
+        Step('Build registration file',
+            [r'gen-registration.py', r'Selenium\bin\Release\Selenium.dll'],
+            [r'SeleniumBasicSetup.pas'],
+            execute, APP_PYTHON_PATH, 'gen-registration.py',
+                os.path.join('Selenium', 'bin', 'Release', 'Selenium.dll'),
+                os.path.join(__dir__, 'SeleniumBasicSetup.pas')),
+        
+        Step('Rebuild excel files',
+            [r'rebuild_exel_files.py', r'Templates\*.xltm', r'Examples\Excel\*.xlsm'],
+            [r'Templates\*.xltm', r'Templates\Xlbin\*', r'Examples\Excel\*.xlsm', r'Examples\Excel\Xlbin\*'],
+            execute, APP_PYTHON_PATH, os.path.join(__dir__, 'rebuild_exel_files.py')),
+        
+        Step('Build setup package',
+            [r'SeleniumBasicSetup.iss', r'SeleniumBasicSetup.pas', r'Selenium\bin\*', r'VbsConsole\bin\Release\*',
+             r'FirefoxAddons\bin\extensions.xpi', r'Scripts\*', r'Templates\*', r'Examples\*',
+             r'References\firefoxdriver.xpi', r'References\chromedriver.exe', r'References\operadriver.exe',
+             r'References\phantomjs.exe', r'References\iedriver.exe', r'References\edgedriver.exe',
+             r'References\exe.config'],
+            [r'SeleniumBasic-%s.exe' % new_version],
+            execute, APP_INNOSETUP_PATH, '/q', '/O' + __dir__, os.path.join(__dir__, 'SeleniumBasicSetup.iss'))
+    ])
     
-    print 'Build setup package ...'
-    execute(APP_INNOSETUP_PATH, '/q', '/O' + __dir__, __dir__ + r'\SeleniumBasicSetup.iss')
+    Trace.save(re.sub(r'\.[^.]+$', '.trace.json', __file__))
+    print ''
+    for line in Trace.summary('step', options.jobs):
+        print line
+        Logger.write('', line)
+    print ''
     
-    print 'Launch install ...'
-    execute(__dir__ + '\SeleniumBasic-%s.exe' % new_version)
+    if not options.no_install:
+        print 'Launch install ...'
+        execute(os.path.join(__dir__, 'SeleniumBasic-%s.exe' % new_version))
 
     print '\nDone'
 
-    
+
+def build_extensions_package():
+    make_dir(os.path.join(__dir__, 'FirefoxAddons', 'bin'))
+    with zipfile.ZipFile(os.path.join(__dir__, 'FirefoxAddons', 'bin', 'extensions.xpi'), 'a') as zip:
+        zip.write(os.path.join(__dir__, 'FirefoxAddons', 'install.rdf'), 'install.rdf')
+        zip.write(os.path.join(__dir__, 'References', 'selenium-ide.xpi'), 'selenium-ide.xpi')
+        zip.write(os.path.join(__dir__, 'FirefoxAddons', 'bin', 'vb-formatters.xpi'), 'vb-formatters.xpi')
+        zip.write(os.path.join(__dir__, 'FirefoxAddons', 'bin', 'implicit-wait.xpi'), 'implicit-wait.xpi')
 
 def set_working_dir(directory):
     make_dir(directory)
@@ -150,19 +207,225 @@ def replace_in_file(filepath, pattern, replacement):
 class CommandException(Exception):
     pass
 
-def execute(*arguments):
+class Step:
+    """Build step with the files it reads and the files it writes.
+    Paths are relative to the project folder and can contain wildcards.
+    The outputs and the folders to clear are deleted before the step runs,
+    unless keep is set for an action updating its outputs in place.
+    rewrites lists the files of other steps the action can build again: the
+    steps reading them wait for this one, but they are not deleted.
+    The other options, like timeout, are passed to the action.
+    The name of the step running in a thread is in Step.local.name.
+    """
+
+    local = threading.local()
+
+    def __init__(self, name, inputs, outputs, action, *arguments, **options):
+        self.name = name
+        self.inputs = [normalize_path(p) for p in inputs]
+        self.outputs = [normalize_path(p) for p in outputs]
+        self.action = action
+        self.arguments = arguments
+        self.clear = [normalize_path(p) for p in options.pop('clear', [])]
+        self.keep = options.pop('keep', False)
+        self.rewrites = [normalize_path(p) for p in options.pop('rewrites', [])]
+        self.options = options
+
+    def depends_on(self, step):
+        return step is not self and (any(fnmatch.fnmatch(output, input) \
+            for output in step.outputs for input in self.inputs) or any(fnmatch.fnmatch(input, path) \
+            for path in step.rewrites for input in self.inputs))
+
+    def run(self):
+        print self.name + ' ...'
+        Step.local.name = self.name
+        for directory in self.clear:
+            clear_dir(directory)
+        for path in self.outputs:
+            if os.path.isfile(path) and not self.keep:
+                os.remove(path)
+        self.action(*self.arguments, **self.options)
+
+    def writes_inputs(self):
+        return any(fnmatch.fnmatch(output, input) or fnmatch.fnmatch(input, output) \
+            for output in self.outputs for input in self.inputs)
+
+    def hash_inputs(self):
+        sha1 = hashlib.sha1(repr((self.action.__name__, self.arguments)))
+        for pattern in self.inputs:
+            for path in find_files(pattern):
+                sha1.update(path + hash_file(path))
+        return sha1.hexdigest()
+
+    def hash_outputs(self):
+        hashes = {}
+        for pattern in self.outputs:
+            paths = find_files(pattern)
+            if not paths:
+                return None
+            for path in paths:
+                hashes[path] = hash_file(path)
+        return hashes
+
+class BuildManifest:
+    """Hash of the inputs and of the outputs of each step from the last build"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.data = {}
+        if os.path.isfile(filepath):
+            with open(filepath, 'r') as f:
+                self.data = json.load(f)
+
+    def clear(self):
+        self.data = {}
+
+    def is_uptodate(self, step, inputs):
+        entry = self.data.get(step.name)
+        return entry is not None and entry['inputs'] == inputs \
+            and entry['outputs'] == step.hash_outputs()
+
+    def update(self, step, inputs):
+        entry = {'inputs': inputs, 'outputs': step.hash_outputs()}
+        with self.lock:
+            self.data[step.name] = entry
+            with open(self.filepath, 'w') as f:
+                json.dump(self.data, f, indent=4, sort_keys=True)
+
+def normalize_path(path):
+    return os.path.normpath(path.replace('\\', '/'))
+
+def find_files(pattern):
+    if not re.search(r'[*?[]', pattern):
+        return [pattern] if os.path.isfile(pattern) else []
+    base = re.sub(r'[^\\/]*[*?[].*$', '', pattern) or '.'
+    files = []
+    for dirpath, dirnames, filenames in os.walk(base):
+        for filename in filenames:
+            path = os.path.normpath(os.path.join(dirpath, filename))
+            if fnmatch.fnmatch(path, pattern):
+                files.append(path)
+    return sorted(files)
+
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(0x100000), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def run_steps(jobs, manifest, steps):
+    """Runs the steps in threads, at most jobs at a time, in the declared order
+    once all the steps producing their inputs are done. A step already built
+    with the same inputs is skipped. Stops scheduling new steps on the first
+    failure and raises it once the running ones are done.
+    """
+    dependencies = dict((step, [s for s in steps if step.depends_on(s)]) for step in steps)
+    condition = threading.Condition()
+    pending, running, done, errors = list(steps), set(), set(), []
+    
+    def run_step(step):
+        try:
+            with Trace.span(step.name, 'step', deps=[s.name for s in dependencies[step]]) as span:
+                inputs = step.hash_inputs()
+                span['skipped'] = manifest.is_uptodate(step, inputs)
+                if span['skipped']:
+                    print step.name + ' (up to date)'
+                else:
+                    step.run()
+                    #the inputs are hashed once, unless the step rewrites them
+                    manifest.update(step, step.hash_inputs() if step.writes_inputs() else inputs)
+        except Exception:
+            errors.append(sys.exc_info())
+        with condition:
+            running.remove(step)
+            if not errors:
+                done.add(step)
+            condition.notify()
+    
+    with condition:
+        while True:
+            for step in list(pending):
+                if errors or len(running) >= jobs:
+                    break
+                if all(s in done for s in dependencies[step]):
+                    pending.remove(step)
+                    running.add(step)
+                    thread = threading.Thread(target=run_step, args=(step,))
+                    thread.daemon = True
+                    thread.start()
+            if not running:
+                break
+            condition.wait()
+    
+    if errors:
+        e_type, e_value, e_trace = errors[0]
+        raise e_type, e_value, e_trace
+    if pending:
+        raise Exception('Circular dependencies between steps:\n ' \
+            + '\n '.join(s.name for s in pending))
+
+def execute(*arguments, **options):
+    """Runs a command and streams its output to the log line by line.
+    Kills the command if it runs longer than the timeout option in seconds.
+    Only the last lines are kept in memory for the exception message.
+    Each line of the log starts with the name of the step, as steps run in parallel.
+    """
     cmd = ' '.join(arguments)
-    Logger.write('cwd> ', os.getcwd())
-    Logger.write('cmd> ', cmd)
-    p = subprocess.Popen(arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    txtout = stdout.decode("utf-8")
-    Logger.write('info> ', txtout)
+    name = '[%s] ' % getattr(Step.local, 'name', os.path.basename(arguments[0]))
+    Logger.write(name + 'cwd> ', os.getcwd())
+    Logger.write(name + 'cmd> ', cmd)
+    start = time.time()
+    p = subprocess.Popen(arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE, \
+        preexec_fn=None if os.name == 'nt' else os.setsid)
+    lines, size = collections.deque(maxlen=100), [0]
+    readers = [threading.Thread(target=read_pipe, args=(pipe, header, lines, size)) \
+        for pipe, header in ((p.stdout, name + 'info> '), (p.stderr, name + 'err> '))]
+    timer = threading.Timer(options['timeout'], kill_process, (p,)) if options.get('timeout') else None
+    for thread in readers + [timer] if timer else readers:
+        thread.daemon = True
+        thread.start()
+    for thread in readers:
+        thread.join()
+    cpu_time = wait_process(p)
+    timed_out = timer and not timer.is_alive()
+    if timer:
+        timer.cancel()
+    Logger.write(name + 'time> ', 'wall %.1fs, cpu %.1fs, output %d bytes' % (time.time() - start, cpu_time, size[0]))
+    if timed_out:
+        raise CommandException(cmd + '\nTimeout after %ss\n' % options['timeout'] + '\n'.join(lines))
     if p.returncode != 0:
-        txterr = stderr.decode("utf-8")
-        raise CommandException(cmd + '\n' + txtout + '\n' + txterr)
+        raise CommandException(cmd + '\n' + '\n'.join(lines))
     Logger.write('', '\n')
 
+def read_pipe(pipe, header, lines, size):
+    for line in iter(pipe.readline, ''):
+        size[0] += len(line)
+        txt = line.decode('utf-8', 'replace').rstrip()
+        lines.append(txt)
+        Logger.write(header, txt)
+    pipe.close()
+
+def kill_process(process):
+    """Kills the process and its children which could hold the pipes open"""
+    if os.name == 'nt':
+        subprocess.call(['taskkill', '/F', '/T', '/PID', str(process.pid)], \
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    else:
+        os.killpg(process.pid, signal.SIGKILL)
+
+def wait_process(process):
+    """Waits for the process to exit and returns the CPU time it used in seconds"""
+    if os.name == 'nt':
+        process.wait()
+        times = [ctypes.c_ulonglong() for i in range(4)]
+        ctypes.windll.kernel32.GetProcessTimes(int(process._handle), *[ctypes.byref(t) for t in times])
+        return (times[2].value + times[3].value) / 1e7
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return usage.ru_utime + usage.ru_stime
+
 def get_input(message):
     try:
         return raw_input(message)
@@ -197,9 +460,11 @@ class Logger:
         header = time.strftime('%H:%M:%S') + (' ' + header if header else '')
         txt = header + message.replace('\r\n', '\n') \
             .replace('\r', '').replace('\n', '\n' + header) + '\n'
-        Logger.file.write(txt)
+        with Logger.lock:
+            Logger.file.write(txt)
     
     def __init__(self):
+        Logger.lock = threading.Lock()
         filename = re.sub(r'\.[^.]+$', '.log', __file__)
         Logger.file = open(filename, mode='w', buffering = 1)
     
@@ -215,4 +480,4 @@ class Logger:
 
 if __name__ == '__main__':
     with Logger() as log:
-        main()
+        main(sys.argv[1:])
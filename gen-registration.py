@@ -0,0 +1,425 @@
+
+"""Script to create the registration file for innosetup.
+Reads the .Net metadata (ECMA-335) of the assembly directly from the file,
+so it runs with CPython and without loading the assembly.
+Usage: python gen-registration.py c:\\assembly.dll c:\\outfile.pas
+"""
+
+import os, sys, re, struct, mmap, hashlib
+
+PROXYSTUBS = [
+    '{00020424-0000-0000-C000-000000000046}',  #DUAL: PSOAInterface
+    '{00020424-0000-0000-C000-000000000046}',  #IUnknown: PSOAInterface
+    '{00020420-0000-0000-C000-000000000046}'   #IDispatch: PSDispatch
+]
+
+def main(args):
+    in_dll = os.path.abspath(args[0])
+    out_file = os.path.abspath(args[1])
+
+    if not os.path.isfile(in_dll):
+        raise Exception('Assembly not found: "%s"' % in_dll)
+
+    print "Assembly : .\%s" % os.path.relpath(in_dll, os.getcwd())
+    print "OutFile  : .\%s" % os.path.relpath(out_file, os.getcwd())
+    print ""
+    print 'Parse the .Net assembly ...'
+
+    with Assembly(in_dll) as assembly:
+        assembly_fullname = assembly.get_fullname()
+        assembly_filename = os.path.basename(in_dll)
+        ass_guid = GetAttribute(assembly, 'System.Runtime.InteropServices.GuidAttribute')
+        ass_vers = GetAttribute(assembly, 'System.Runtime.InteropServices.TypeLibVersionAttribute')
+        ass_desc = GetAttribute(assembly, 'System.Reflection.AssemblyDescriptionAttribute')
+
+        lines_classes = []
+        lines_interfaces = []
+        lines_values = []
+
+        for type in assembly.get_exported_types():
+            comvisible = GetAttribute(type, 'System.Runtime.InteropServices.ComVisibleAttribute', silent = True)
+            if comvisible and comvisible[0] == True:
+                att_guid = GetAttribute(type, 'System.Runtime.InteropServices.GuidAttribute')
+                guid = '{' + att_guid[0] + '}'
+                if type.is_class():
+                    if type.has_default_constructor():
+                        progid = GetAttribute(type, 'System.Runtime.InteropServices.ProgIdAttribute')[0]
+                        lines_classes.append("RegClass(lib, '%s', '%s', '%s');" % (guid, progid, type.fullname))
+                elif type.is_valuetype():
+                    lines_values.append("RegRecord(lib, '%s', '%s');" % (guid, type.fullname))
+                elif type.is_interface():
+                    interfaceType = GetAttribute(type, 'System.Runtime.InteropServices.InterfaceTypeAttribute')[0]
+                    proxystub = PROXYSTUBS[int(interfaceType)]
+                    lines_interfaces.append("RegInterface(lib, '%s', '%s', '%s');" % (guid, type.name, proxystub))
+
+        runtime_version = assembly.runtime_version
+
+    print 'Genereate the registration file ...'
+
+    with open(out_file, 'w') as f :
+        f.write("{\n")
+        f.write(" Code generated at each build by gen-registration.py\n")
+        f.write(" This is a subset of SeleniumBasicSetup.iss\n")
+        f.write("}\n\n")
+
+        f.write("lib.Guid := '{%s}';\n" % ass_guid[0])
+        f.write("lib.FullName := '%s';\n" % assembly_fullname)
+        f.write("lib.Description := '%s';\n" % ass_desc[0])
+        f.write("lib.TypeVersion := '%s.%s';\n" % (ass_vers[0], ass_vers[1]))
+        f.write("lib.PathDll := ExpandConstant('{app}\%s');\n" % assembly_filename)
+        f.write("lib.PathTlb32 := ExpandConstant('{app}\%s');\n" % re.sub('\.[^.]+$', '32.tlb', assembly_filename))
+        f.write("lib.PathTlb64 := ExpandConstant('{app}\%s');\n" % re.sub('\.[^.]+$', '64.tlb', assembly_filename))
+        f.write("lib.Runtime := '%s';\n" % runtime_version)
+        f.write("\n")
+        f.write("RegTypeLib(lib);\n")
+        for lines in [lines_classes, lines_interfaces, lines_values]:
+            f.write('\n')
+            lines.sort()
+            for line in lines:
+                f.write(line + '\n')
+
+    print "\nDone"
+
+def GetAttribute(obj, att_typename, silent = False):
+    """Returns the fixed arguments of the first attribute of a type"""
+    attributes = obj.get_attributes(att_typename)
+    if len(attributes) == 0 :
+        if not silent:
+            raise Exception("Attribute {0} is missing on type {1}".format(att_typename.split('.')[-1], obj.fullname))
+        return None
+    return attributes[0]
+
+
+#metadata tables (ECMA-335 II.22) : column sizes in bytes, heap indexes,
+#table indexes or coded indexes
+STRING, GUID, BLOB = 'S', 'G', 'B'
+
+def T(table):
+    return ('T', table)
+
+TABLES = {
+    0x00: [2, STRING, GUID, GUID, GUID],                                        #Module
+    0x01: ['ResolutionScope', STRING, STRING],                                  #TypeRef
+    0x02: [4, STRING, STRING, 'TypeDefOrRef', T(0x04), T(0x06)],                #TypeDef
+    0x03: [T(0x04)],                                                            #FieldPtr
+    0x04: [2, STRING, BLOB],                                                    #Field
+    0x05: [T(0x06)],                                                            #MethodPtr
+    0x06: [4, 2, 2, STRING, BLOB, T(0x08)],                                     #MethodDef
+    0x07: [T(0x08)],                                                            #ParamPtr
+    0x08: [2, 2, STRING],                                                       #Param
+    0x09: [T(0x02), 'TypeDefOrRef'],                                            #InterfaceImpl
+    0x0A: ['MemberRefParent', STRING, BLOB],                                    #MemberRef
+    0x0B: [1, 1, 'HasConstant', BLOB],                                          #Constant
+    0x0C: ['HasCustomAttribute', 'CustomAttributeType', BLOB],                  #CustomAttribute
+    0x0D: ['HasFieldMarshal', BLOB],                                            #FieldMarshal
+    0x0E: [2, 'HasDeclSecurity', BLOB],                                         #DeclSecurity
+    0x0F: [2, 4, T(0x02)],                                                      #ClassLayout
+    0x10: [4, T(0x04)],                                                         #FieldLayout
+    0x11: [BLOB],                                                               #StandAloneSig
+    0x12: [T(0x02), T(0x14)],                                                   #EventMap
+    0x13: [T(0x14)],                                                            #EventPtr
+    0x14: [2, STRING, 'TypeDefOrRef'],                                          #Event
+    0x15: [T(0x02), T(0x17)],                                                   #PropertyMap
+    0x16: [T(0x17)],                                                            #PropertyPtr
+    0x17: [2, STRING, BLOB],                                                    #Property
+    0x18: [2, T(0x06), 'HasSemantics'],                                         #MethodSemantics
+    0x19: [T(0x02), 'MethodDefOrRef', 'MethodDefOrRef'],                        #MethodImpl
+    0x1A: [STRING],                                                             #ModuleRef
+    0x1B: [BLOB],                                                               #TypeSpec
+    0x1C: [2, 'MemberForwarded', STRING, T(0x1A)],                              #ImplMap
+    0x1D: [4, T(0x04)],                                                         #FieldRVA
+    0x1E: [4, 4],                                                               #EncLog
+    0x1F: [4],                                                                  #EncMap
+    0x20: [4, 2, 2, 2, 2, 4, BLOB, STRING, STRING],                             #Assembly
+    0x21: [4],                                                                  #AssemblyProcessor
+    0x22: [4, 4, 4],                                                            #AssemblyOS
+    0x23: [2, 2, 2, 2, 4, BLOB, STRING, STRING, BLOB],                          #AssemblyRef
+    0x24: [4, T(0x23)],                                                         #AssemblyRefProcessor
+    0x25: [4, 4, 4, T(0x23)],                                                   #AssemblyRefOS
+    0x26: [4, STRING, BLOB],                                                    #File
+    0x27: [4, 4, STRING, STRING, 'Implementation'],                             #ExportedType
+    0x28: [4, 4, STRING, 'Implementation'],                                     #ManifestResource
+    0x29: [T(0x02), T(0x02)],                                                   #NestedClass
+    0x2A: [2, 2, 'TypeOrMethodDef', STRING],                                    #GenericParam
+    0x2B: ['MethodDefOrRef', BLOB],                                             #MethodSpec
+    0x2C: [T(0x2A), 'TypeDefOrRef'],                                            #GenericParamConstraint
+}
+
+#coded indexes (ECMA-335 II.24.2.6) : tag size in bits and tables
+CODED_INDEXES = {
+    'TypeDefOrRef': (2, [0x02, 0x01, 0x1B]),
+    'HasConstant': (2, [0x04, 0x08, 0x17]),
+    'HasCustomAttribute': (5, [0x06, 0x04, 0x01, 0x02, 0x08, 0x09, 0x0A, 0x00, 0x0E, 0x17, 0x14,
+        0x11, 0x1A, 0x1B, 0x20, 0x23, 0x26, 0x27, 0x28, 0x2A, 0x2C, 0x2B]),
+    'HasFieldMarshal': (1, [0x04, 0x08]),
+    'HasDeclSecurity': (2, [0x02, 0x06, 0x20]),
+    'MemberRefParent': (3, [0x02, 0x01, 0x1A, 0x06, 0x1B]),
+    'HasSemantics': (1, [0x14, 0x17]),
+    'MethodDefOrRef': (1, [0x06, 0x0A]),
+    'MemberForwarded': (1, [0x04, 0x06]),
+    'Implementation': (2, [0x26, 0x23, 0x27]),
+    'CustomAttributeType': (3, [None, None, 0x06, 0x0A, None]),
+    'ResolutionScope': (2, [0x00, 0x1A, 0x23, 0x01]),
+    'TypeOrMethodDef': (1, [0x02, 0x06]),
+}
+
+TYPEDEF, TYPEREF, METHODDEF, MEMBERREF, ASSEMBLY, NESTEDCLASS, CUSTOMATTRIBUTE = \
+    0x02, 0x01, 0x06, 0x0A, 0x20, 0x29, 0x0C
+
+class Assembly:
+    """.Net assembly metadata read from a memory map of the file.
+    Decodes the tables, the #Strings and #Blob heaps and the fixed arguments
+    of the custom attributes, without loading the assembly.
+    """
+
+    def __init__(self, filepath):
+        self.file = open(filepath, 'rb')
+        self.view = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.filename = os.path.basename(filepath)
+        self.read_metadata()
+        self.read_attributes()
+        self.fullname = self.get_fullname()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.view.close()
+        self.file.close()
+
+    def read_metadata(self):
+        view = self.view
+        if view[:2] != 'MZ':
+            raise Exception('Not a PE file: ' + self.filename)
+        pe, = struct.unpack_from('<I', view, 0x3c)
+        section_count, optional_size = struct.unpack_from('<H12xH', view, pe + 6)
+        optional = pe + 24
+        magic, = struct.unpack_from('<H', view, optional)
+        directories = optional + (96 if magic == 0x10b else 112)
+        cli_rva, cli_size = struct.unpack_from('<II', view, directories + 14 * 8)
+        if not cli_rva:
+            raise Exception('Not a .Net assembly: ' + self.filename)
+        self.sections = [struct.unpack_from('<8xIIII', view, optional + optional_size + i * 40) \
+            for i in range(section_count)]
+        metadata_rva, = struct.unpack_from('<I', view, self.offset(cli_rva) + 8)
+        root = self.offset(metadata_rva)
+        version_length, = struct.unpack_from('<I', view, root + 12)
+        self.runtime_version = view[root + 16: root + 16 + version_length].rstrip('\0')
+        position = root + 16 + version_length + 2
+        stream_count, = struct.unpack_from('<H', view, position)
+        position += 2
+        streams = {}
+        for i in range(stream_count):
+            offset, size = struct.unpack_from('<II', view, position)
+            name = view[position + 8: view.find('\0', position + 8)]
+            streams[name] = root + offset
+            position += 8 + (len(name) + 4 & ~3)
+        self.strings = streams['#Strings']
+        self.blobs = streams.get('#Blob', 0)
+        self.read_tables(streams.get('#~') or streams['#-'])
+
+    def offset(self, rva):
+        for virtual_size, address, raw_size, raw_offset in self.sections:
+            if address <= rva < address + max(virtual_size, raw_size):
+                return rva - address + raw_offset
+        raise Exception('Invalid RVA %x in %s' % (rva, self.filename))
+
+    def read_tables(self, position):
+        heap_sizes, = struct.unpack_from('<B', self.view, position + 6)
+        valid, = struct.unpack_from('<Q', self.view, position + 8)
+        position += 24
+        present = [i for i in range(64) if valid >> i & 1]
+        self.counts = dict((i, 0) for i in TABLES)
+        for i in present:
+            self.counts[i], = struct.unpack_from('<I', self.view, position)
+            position += 4
+        sizes = {
+            STRING: 4 if heap_sizes & 1 else 2,
+            GUID: 4 if heap_sizes & 2 else 2,
+            BLOB: 4 if heap_sizes & 4 else 2
+        }
+        self.tables = {}
+        for i in present:
+            if i not in TABLES:
+                raise Exception('Unknown metadata table %x in %s' % (i, self.filename))
+            columns = [self.get_column_size(column, sizes) for column in TABLES[i]]
+            formats = '<' + ''.join({1: 'B', 2: 'H', 4: 'I'}[size] for size in columns)
+            row_size = sum(columns)
+            self.tables[i] = [struct.unpack_from(formats, self.view, position + row * row_size) \
+                for row in range(self.counts[i])]
+            position += row_size * self.counts[i]
+
+    def get_column_size(self, column, sizes):
+        if isinstance(column, str) and column in sizes:
+            return sizes[column]
+        if isinstance(column, str):
+            bits, tables = CODED_INDEXES[column]
+            rows = max(self.counts.get(t, 0) for t in tables if t is not None)
+            return 2 if rows < 1 << 16 - bits else 4
+        if isinstance(column, tuple):
+            return 2 if self.counts[column[1]] < 1 << 16 else 4
+        return column
+
+    def row(self, table, index):
+        return self.tables[table][index - 1]
+
+    def decode(self, coded_index, value):
+        bits, tables = CODED_INDEXES[coded_index]
+        return tables[value & (1 << bits) - 1], value >> bits
+
+    def get_string(self, index):
+        start = self.strings + index
+        return self.view[start: self.view.find('\0', start)]
+
+    def get_blob(self, index):
+        length, position = read_compressed(self.view, self.blobs + index)
+        return self.view[position: position + length]
+
+    def get_fullname(self):
+        hash_alg, major, minor, build, revision, flags, public_key, name, culture = \
+            self.row(ASSEMBLY, 1)
+        public_key = self.get_blob(public_key)
+        token = hashlib.sha1(public_key).digest()[-8:][::-1].encode('hex') if public_key else 'null'
+        return '%s, Version=%d.%d.%d.%d, Culture=%s, PublicKeyToken=%s' % (self.get_string(name), \
+            major, minor, build, revision, self.get_string(culture) or 'neutral', token)
+
+    def get_typename(self, table, index):
+        if table == TYPEDEF:
+            return self.types[index - 1].fullname
+        if table == TYPEREF:
+            scope, name, namespace = self.row(TYPEREF, index)
+            scope_table, scope_index = self.decode('ResolutionScope', scope)
+            name = self.get_string(name)
+            if scope_table == TYPEREF:
+                return self.get_typename(TYPEREF, scope_index) + '+' + name
+            namespace = self.get_string(namespace)
+            return namespace + '.' + name if namespace else name
+        return None
+
+    def read_attributes(self):
+        self.types = [TypeDef(self, index) for index in range(1, self.counts[TYPEDEF] + 1)]
+        for nested, enclosing in self.tables.get(NESTEDCLASS, []):
+            self.types[nested - 1].enclosing = self.types[enclosing - 1]
+        self.attributes = {}
+        for parent, ctor, value in self.tables.get(CUSTOMATTRIBUTE, []):
+            ctor_table, ctor_index = self.decode('CustomAttributeType', ctor)
+            if ctor_table == METHODDEF:
+                owner = next(t for t in reversed(self.types) if t.method_list <= ctor_index)
+                typename, signature = owner.fullname, self.row(METHODDEF, ctor_index)[4]
+            else:
+                cls, name, signature = self.row(MEMBERREF, ctor_index)
+                typename = self.get_typename(*self.decode('MemberRefParent', cls))
+            self.attributes.setdefault(self.decode('HasCustomAttribute', parent), []) \
+                .append((typename, signature, value))
+
+    def get_attributes(self, typename, token=(ASSEMBLY, 1)):
+        """Returns the fixed arguments of each attribute of this type on the token.
+        Only the requested attributes are decoded.
+        """
+        return [read_attribute(self.get_blob(signature), self.get_blob(value))
+            for name, signature, value in self.attributes.get(token, []) if name == typename]
+
+    def get_exported_types(self):
+        return [t for t in self.types if t.is_exported()]
+
+class TypeDef:
+    """Type defined in the assembly"""
+
+    def __init__(self, assembly, index):
+        self.assembly = assembly
+        self.index = index
+        self.flags, name, namespace, self.extends, field_list, self.method_list = \
+            assembly.row(TYPEDEF, index)
+        self.name = assembly.get_string(name)
+        self.namespace = assembly.get_string(namespace)
+        self.enclosing = None
+
+    @property
+    def fullname(self):
+        if self.enclosing:
+            return self.enclosing.fullname + '+' + self.name
+        return self.namespace + '.' + self.name if self.namespace else self.name
+
+    def get_attributes(self, typename):
+        return self.assembly.get_attributes(typename, (TYPEDEF, self.index))
+
+    def is_exported(self):
+        visibility = self.flags & 0x7
+        if self.enclosing:
+            return visibility == 2 and self.enclosing.is_exported()  #NestedPublic
+        return visibility == 1  #Public
+
+    def is_interface(self):
+        return bool(self.flags & 0x20)
+
+    def is_valuetype(self):
+        if not self.extends:
+            return False
+        base = self.assembly.get_typename(*self.assembly.decode('TypeDefOrRef', self.extends))
+        return base in ('System.ValueType', 'System.Enum') and self.fullname != 'System.Enum'
+
+    def is_class(self):
+        return not self.is_interface() and not self.is_valuetype()
+
+    def get_methods(self):
+        types = self.assembly.types
+        end = types[self.index].method_list if self.index < len(types) \
+            else self.assembly.counts[METHODDEF] + 1
+        return [self.assembly.row(METHODDEF, i) for i in range(self.method_list, end)]
+
+    def has_default_constructor(self):
+        """True if the type has a public instance constructor without parameters"""
+        for rva, impl_flags, flags, name, signature in [m[:5] for m in self.get_methods()]:
+            if self.assembly.get_string(name) == '.ctor' and flags & 0x7 == 6 and not flags & 0x10:
+                if read_compressed(self.assembly.get_blob(signature), 1)[0] == 0:
+                    return True
+        return False
+
+def read_compressed(data, position):
+    """Reads an unsigned compressed integer (ECMA-335 II.23.2)"""
+    b = ord(data[position])
+    if b & 0x80 == 0:
+        return b, position + 1
+    if b & 0xc0 == 0x80:
+        return (b & 0x3f) << 8 | ord(data[position + 1]), position + 2
+    return struct.unpack_from('>I', data, position)[0] & 0x1fffffff, position + 4
+
+def read_attribute(signature, value):
+    """Decodes the fixed arguments of a custom attribute from the signature of
+    its constructor. An enum argument is read as an int32.
+    """
+    count, position = read_compressed(signature, 1)
+    position += 1  #return type: void
+    arguments, offset = [], 2  #prolog 0x0001
+    for i in range(count):
+        element = ord(signature[position])
+        position += 1
+        if element == 0x11:  #valuetype: enum
+            position = read_compressed(signature, position)[1]
+            element = 0x08
+        if element == 0x0e:  #string
+            if value[offset] == '\xff':
+                arguments.append(None)
+                offset += 1
+            else:
+                length, offset = read_compressed(value, offset)
+                arguments.append(value[offset: offset + length])
+                offset += length
+        elif element in ELEMENT_FORMATS:
+            format = ELEMENT_FORMATS[element]
+            arguments.append(struct.unpack_from(format, value, offset)[0])
+            offset += struct.calcsize(format)
+        else:
+            raise Exception('Unsupported attribute argument type %x' % element)
+    return arguments
+
+ELEMENT_FORMATS = {
+    0x02: '<?', 0x03: '<H', 0x04: '<b', 0x05: '<B', 0x06: '<h', 0x07: '<H',
+    0x08: '<i', 0x09: '<I', 0x0a: '<q', 0x0b: '<Q', 0x0c: '<f', 0x0d: '<d'
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 :
+        main(sys.argv[1:])
+    else:
+        print __doc__
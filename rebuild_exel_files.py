@@ -2,106 +2,462 @@
 """Rebuild Excel files
 """
 
-import sys, os, shutil, zipfile, re, glob, tempfile
-from win32com import client  #http://sourceforge.net/projects/pywin32/files/pywin32/
+import sys, os, shutil, zipfile, re, glob, tempfile, struct, argparse, multiprocessing, collections, pickle, traceback, Queue
+from ziputils import rewrite_zip
+try:
+    from win32com import client  #http://sourceforge.net/projects/pywin32/files/pywin32/
+except ImportError:
+    client = None
 
 def main(args):
+    parser = argparse.ArgumentParser(description='Rebuild the Excel files')
+    parser.add_argument('--export', metavar='DIR', help='Only export the VBA modules of each file to DIR, without Excel')
+    parser.add_argument('--jobs', type=int, default=min(multiprocessing.cpu_count(), EXCEL_MAX_INSTANCES), help='Number of Excel instances run in parallel')
+    args = parser.parse_args(args)
+    
     print __doc__
     
-    for folder in (r'\Templates', r'\Examples\Excel'):
-        rebuild(__dir__ + folder)
+    folders = [os.path.join(__dir__, folder) for folder in ('Templates', os.path.join('Examples', 'Excel'))]
+    if args.export:
+        for folder in folders:
+            export(folder, args.export)
+    else:
+        rebuild(folders, args.jobs)
     
     print "\nDone"
 
 
-def rebuild(directory):
-    xlbin_dir = make_dir(directory + r'\Xlbin')
+def export(directory, out_dir):
+    for file in glob.glob(os.path.join(directory, '*.xl?m')):
+        print "Export %s ..." % file
+        export_vba(file, make_dir(os.path.join(out_dir, get_shortname(file))))
+
+
+def rebuild(folders, jobs, backend=None):
+    files = []
+    for directory in folders:
+        make_dir(os.path.join(directory, 'Xlbin'))
+        files.extend(glob.glob(os.path.join(directory, '*.xl?m')))
     
-    for file in glob.glob(directory + r"/*.xl?m"):
-        shortname = get_shortname(file)
-        extention = get_extention(file)
-        
-        print "Extract %s ..." % file
-        tmp_folder = extract_excel(file)
-        
-        print "Rebuild %s ..." % shortname
-        (wb, wb_file) = build_excel(tmp_folder, extention)
-        wb.VBProject.References.AddFromGuid("{0277FC34-FD1B-4616-BB19-A9AABCAF2A70}", 2, 0)
-        
-        if extention == ".xlsm":
-            print "Save %s.xlsm ..." % shortname
-            wb.SaveAs(directory + r'\%s.xlsm' % shortname, xlOpenXMLWorkbookMacroEnabled)
-            print "Save %s.xls ..." % shortname
-            wb.SaveAs(xlbin_dir + r'\%s.xls' % shortname,  xlWorkbook8)
-            
-        elif extention == ".xltm":
-            print "Save %s.xltm ..." % shortname
-            wb.SaveAs(directory + r'\%s.xltm' % shortname, xlOpenXMLTemplateMacroEnabled)
-            print "Save %s.xlt ..." % shortname
-            wb.SaveAs(xlbin_dir + r'\%s.xlt' % shortname,  xlTemplate8)
-        
-        wb.Application.Quit()
-        shutil.rmtree(tmp_folder)
-        os.remove(wb_file)
-        print ""
+    with ExcelPool(max(1, min(jobs, len(files))), backend) as pool:
+        pool.map(rebuild_file, files)
+
+def rebuild_file(xl, file):
+    directory = os.path.dirname(file)
+    xlbin_dir = os.path.join(directory, 'Xlbin')
+    shortname = get_shortname(file)
+    extention = get_extention(file)
     
-def build_excel(folder, extension):
-    # Create excel file for folder
-    file = tempfile.NamedTemporaryFile(suffix=extension).name
-    build_zip(folder, file, r".*", r"^vba\\")
+    print "Rebuild %s ..." % shortname
+    (wb, wb_file) = build_excel(xl, file, extention)
+    wb.VBProject.References.AddFromGuid("{0277FC34-FD1B-4616-BB19-A9AABCAF2A70}", 2, 0)
     
-    # Add VBA code
-    xl = CreateObject("Excel.Application")
+    if extention == ".xlsm":
+        print "Save %s.xlsm ..." % shortname
+        wb.SaveAs(os.path.join(directory, shortname + '.xlsm'), xlOpenXMLWorkbookMacroEnabled)
+        print "Save %s.xls ..." % shortname
+        wb.SaveAs(os.path.join(xlbin_dir, shortname + '.xls'),  xlWorkbook8)
+        
+    elif extention == ".xltm":
+        print "Save %s.xltm ..." % shortname
+        wb.SaveAs(os.path.join(directory, shortname + '.xltm'), xlOpenXMLTemplateMacroEnabled)
+        print "Save %s.xlt ..." % shortname
+        wb.SaveAs(os.path.join(xlbin_dir, shortname + '.xlt'),  xlTemplate8)
+    
+    wb.Close(False)
+    os.remove(wb_file)
+
+
+class ExcelPool:
+    """Pool of worker processes, each one holding a warm Excel application.
+    An application is reused from one workbook to the next and reset in between.
+    A worker process which dies is replaced and its job fails with WorkerCrashed.
+    The backend is a function returning a new application, CreateExcel by default.
+    """
+
+    def __init__(self, size, backend=None):
+        self.backend = backend or CreateExcel
+        self.results = multiprocessing.Queue()
+        self.workers = [self.start_worker(index) for index in range(size)]
+
+    def start_worker(self, index):
+        jobs = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_worker, args=(self.backend, index, jobs, self.results))
+        process.daemon = True
+        process.start()
+        return process, jobs
+
+    def map(self, func, items):
+        """Calls func(xl, item) for each item in the worker processes.
+        The first error is raised once all the items are processed.
+        """
+        pending = collections.deque(enumerate(items))
+        results, errors = [None] * len(pending), []
+        idle, running = range(len(self.workers)), {}
+        while pending or running:
+            while pending and idle:
+                index = idle.pop()
+                running[index] = pending.popleft()
+                self.workers[index][1].put((running[index][0], func, running[index][1]))
+            try:
+                index, position, error, result = self.results.get(timeout=1)
+            except Queue.Empty:
+                for index, (position, item) in running.items():
+                    if not self.workers[index][0].is_alive():
+                        errors.append((position, WorkerCrashed(item, self.workers[index][0].exitcode)))
+                        self.workers[index] = self.start_worker(index)
+                        del running[index]
+                        idle.append(index)
+                continue
+            del running[index]
+            idle.append(index)
+            if error:
+                errors.append((position, error))
+            else:
+                results[position] = result
+        if errors:
+            raise min(errors)[1]
+        return results
+
+    def close(self):
+        for process, jobs in self.workers:
+            jobs.put(None)
+        for process, jobs in self.workers:
+            process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+class WorkerCrashed(Exception):
+
+    def __init__(self, item, exitcode):
+        self.__data__ = (item, exitcode)
+
+    def __str__(self):
+        return 'Worker process died with exit code %s on %s' % self.__data__[::-1]
+
+_worker = {}
+
+def run_worker(backend, index, jobs, results):
+    """Runs the jobs received by a worker process until it gets None"""
+    init_worker(backend)
+    try:
+        for position, func, item in iter(jobs.get, None):
+            try:
+                results.put((index, position, None, run_job((func, item))))
+            except Exception as ex:
+                try:
+                    pickle.dumps(ex)
+                except Exception:
+                    ex = Exception(traceback.format_exc())
+                results.put((index, position, ex, None))
+    finally:
+        quit_excel()
+
+def init_worker(backend):
+    _worker['backend'] = backend
+    _worker['xl'] = new_excel(backend)
+
+def run_job(args):
+    func, item = args
+    try:
+        return func(_worker['xl'], item)
+    finally:
+        try:
+            reset_excel(_worker['xl'])
+        except Exception:
+            #the application is broken, replace it for the next job
+            quit_excel()
+            _worker['xl'] = new_excel(_worker['backend'])
+
+def new_excel(backend):
+    xl = backend()
+    reset_excel(xl)
+    return xl
+
+def reset_excel(xl):
+    for wb in list(xl.Workbooks):
+        wb.Close(False)
     xl.EnableEvents = False
     xl.DisplayAlerts = False
-    wb = xl.Workbooks.Open(file)
+
+def quit_excel():
+    try:
+        _worker['xl'].Quit()
+    except Exception:
+        pass
+
+def build_excel(xl, file, extension):
+    # Copy the excel file without its VBA project
+    fd, wb_file = tempfile.mkstemp(suffix=extension)
+    os.close(fd)
+    rewrite_zip(file, wb_file, skip=r"vbaProject\.bin$")
+    
+    # Add VBA code
+    wb = xl.Workbooks.Open(wb_file)
+    import_vba(wb, file, xl)
+    return (wb, wb_file)
+
+
+def import_vba(wb, file, xl):
+    """Imports in a workbook the VBA modules of an Excel file"""
     components = wb.VBProject.VBComponents
-    for (dirpath, dirnames, filenames) in os.walk(folder + r"\vba"):
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
-            if filename.find(".") == -1:
-                module = components.Item(filename).CodeModule
-                with open(file_path, "r") as f:
-                    code = f.read()
-                    module.InsertLines(1, code)
-            else:
+    modules = read_vba_modules(file)
+    if any(type == vbext_ct_MSForm for name, type, code in modules):
+        folder = tempfile.mkdtemp()
+        try:
+            export_vba_excel(file, folder, xl)
+            files = []
+            for filename in os.listdir(folder):
+                with open(os.path.join(folder, filename), 'rb') as f:
+                    files.append((filename, f.read()))
+        finally:
+            shutil.rmtree(folder)
+    else:
+        files = get_vba_files(modules)
+    for filename, code in files:
+        if filename.find(".") == -1:
+            components.Item(filename).CodeModule.InsertLines(1, code)
+        elif not filename.endswith('.frx'):
+            #the VBE only imports from a file
+            fd, file_path = tempfile.mkstemp(suffix=get_extention(filename))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(code)
+            try:
                 components.Import(file_path)
-    return (wb, file)
+            finally:
+                os.remove(file_path)
 
 
-def extract_excel(file):
-    # Create temporary folders
-    folder = tempfile.mkdtemp()
-    dir_vba = make_dir(folder + r'\vba')
-    
-    # Extract the file
-    extract_zip(file, folder, r".*", r".*vbaProject\.bin$")
-    
-    # Extract the VBA code
-    xl = CreateObject("Excel.Application")
-    xl.EnableEvents = False
-    wb = xl.Workbooks.Open(file)
+def export_vba(file, folder, xl=None):
+    """Exports the VBA modules of an Excel file the way the VBE does.
+    Reads the vbaProject.bin in the archive, so Excel is only needed for user forms.
+    """
+    modules = read_vba_modules(file)
+    if any(type == vbext_ct_MSForm for name, type, code in modules):
+        return export_vba_excel(file, folder, xl)
+    for filename, code in get_vba_files(modules):
+        with open(os.path.join(folder, filename), 'wb') as f:
+            f.write(code)
+
+def get_vba_files(modules):
+    """Returns the files (name, content) the VBE would export for the modules.
+    A class module only keeps the attributes the VBE writes in a .cls file.
+    A document module has no extension and is only exported if it has some code.
+    """
+    files = []
+    for name, type, code in modules:
+        if type in extensions:
+            if type == vbext_ct_ClassModule:
+                header = re.match(r'(Attribute VB_\w+ = .*\r?\n)*', code).group(0)
+                attributes = re.sub(r'Attribute (VB_\w+) = .*\r?\n', \
+                    lambda m: m.group(0) if m.group(1) in CLASS_ATTRIBUTES else '', header)
+                code = CLASS_HEADER + attributes + code[len(header):]
+            files.append(('%s.%s' % (name, extensions[type]), code))
+        else:
+            code = re.sub(r'^(Attribute VB_\w+ = .*\r?\n)+', '', code)
+            code = re.sub(r'\r?\n\Z', '', code)
+            if code:
+                files.append((name, code))
+    return files
+
+def export_vba_excel(file, folder, xl=None):
+    app = xl or new_excel(CreateExcel)
+    wb = app.Workbooks.Open(file)
     try:
         for item in wb.VBProject.VBComponents:
             if item.Type < 4:
                 ext = extensions.get(item.Type, None)
-                item.Export(r"%s\%s.%s" % (dir_vba, item.Name, ext))
+                item.Export(os.path.join(folder, '%s.%s' % (item.Name, ext)))
             else:
                 module = item.CodeModule
                 count = module.CountOfLines
                 if count:
-                    with open(r"%s\%s" % (dir_vba, item.Name), "w") as f:
+                    with open(os.path.join(folder, item.Name), "w") as f:
                         code = module.Lines(1, count)
                         f.write(code)
     finally:
         wb.Close(False)
-        xl.Quit()
+        if not xl:
+            app.Quit()
+
+def read_vba_modules(file):
+    """Returns the VBA modules (name, type, code) of an Excel file.
+    The type is one of the vbext_ct_* constants and the code is in the codepage of the project.
+    """
+    with zipfile.ZipFile(file, 'r') as zip:
+        names = [n for n in zip.namelist() if re.match(r".*vbaProject\.bin$", n)]
+        if not names:
+            return []
+        ole = OleFile(zip.read(names[0]))
+    return VbaProject(ole).modules
+
+
+class OleFile:
+    """Reader for an OLE compound file (MS-CFB) held in memory"""
+
+    def __init__(self, data):
+        if data[:8] != '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1':
+            raise Exception('Invalid compound file')
+        self.data = data
+        self.sector_shift, self.mini_sector_shift = struct.unpack_from('<HH', data, 0x1e)
+        dir_start, = struct.unpack_from('<I', data, 0x30)
+        self.mini_cutoff, minifat_start, minifat_count, difat_start, difat_count = \
+            struct.unpack_from('<IIIII', data, 0x38)
         
-    return folder
+        #sectors of the FAT, from the header and the DIFAT chain
+        fat_sectors = list(struct.unpack_from('<109I', data, 0x4c))
+        per_sector = (1 << self.sector_shift) / 4
+        sector = difat_start
+        for i in range(difat_count):
+            entries = struct.unpack_from('<%dI' % per_sector, data, self.offset(sector))
+            fat_sectors.extend(entries[:-1])
+            sector = entries[-1]
+        self.fat = []
+        for sector in fat_sectors:
+            if sector < MAXREGSECT:
+                self.fat.extend(struct.unpack_from('<%dI' % per_sector, data, self.offset(sector)))
         
+        self.minifat = []
+        if minifat_count:
+            minifat = self.read_chain(minifat_start)
+            self.minifat = struct.unpack('<%dI' % (len(minifat) / 4), minifat)
         
-def CreateObject(progid):
-    return client.Dispatch(progid)
+        directory = self.read_chain(dir_start)
+        self.entries = [struct.unpack_from('<64sHBxIII36xIQ', directory, i) \
+            for i in range(0, len(directory), 128)]
+        root = self.entries[0]
+        self.ministream = self.read_chain(root[6])[:root[7]]
+        
+        self.streams = {}
+        self.read_storage(root[5], '')
+
+    def offset(self, sector):
+        return (sector + 1) << self.sector_shift
+
+    def read_chain(self, sector, fat=None, shift=None):
+        fat = fat or self.fat
+        shift = shift or self.sector_shift
+        data = self.data if fat is self.fat else self.ministream
+        base = 1 if fat is self.fat else 0
+        blocks = []
+        while sector < MAXREGSECT:
+            if len(blocks) > len(fat):
+                raise Exception('Cyclic sector chain')
+            start = (sector + base) << shift
+            blocks.append(data[start: start + (1 << shift)])
+            sector = fat[sector]
+        return ''.join(blocks)
+
+    def read_storage(self, sid, path):
+        #walks the red-black tree of the siblings, then the children of each storage
+        stack = [sid]
+        while stack:
+            sid = stack.pop()
+            if sid >= MAXREGSECT:
+                continue
+            name, name_size, type, left, right, child, start, size = self.entries[sid]
+            stack.extend((left, right))
+            name = name[:max(0, name_size - 2)].decode('utf-16-le')
+            if type == 1:
+                self.read_storage(child, path + name + '/')
+            elif type == 2:
+                self.streams[(path + name).lower()] = (start, size & 0xffffffff)
+
+    def read(self, path):
+        """Returns the content of a stream from its path (case insensitive)"""
+        start, size = self.streams[path.lower()]
+        if size < self.mini_cutoff:
+            return self.read_chain(start, self.minifat, self.mini_sector_shift)[:size]
+        return self.read_chain(start)[:size]
+
+
+class VbaProject:
+    """VBA project stored in an OLE file (MS-OVBA)"""
+
+    def __init__(self, ole):
+        self.ole = ole
+        self.codepage = 'cp1252'
+        self.modules = []
+        types = self.read_module_types()
+        for name, stream, offset in self.read_dir():
+            code = decompress(ole.read('VBA/' + stream)[offset:])
+            self.modules.append((name, types.get(name, vbext_ct_StdModule), code))
+
+    def read_module_types(self):
+        #the PROJECT stream is an ini text listing the modules by kind
+        types = {}
+        kinds = {'Module': vbext_ct_StdModule, 'Class': vbext_ct_ClassModule, \
+            'BaseClass': vbext_ct_MSForm, 'Document': vbext_ct_Document}
+        for line in self.ole.read('PROJECT').splitlines():
+            match = re.match(r'(\w+)=([^/]+)', line)
+            if match and match.group(1) in kinds:
+                types[match.group(2)] = kinds[match.group(1)]
+        return types
+
+    def read_dir(self):
+        """Returns the name, stream name and source offset of each module"""
+        data = decompress(self.ole.read('VBA/dir'))
+        modules, module, position = [], {}, 0
+        while position < len(data):
+            id, size = struct.unpack_from('<HI', data, position)
+            if id == 0x09:  #PROJECTVERSION: the size doesn't include the minor version
+                size = 6
+            value = data[position + 6: position + 6 + size]
+            position += 6 + size
+            if id == 0x03:  #PROJECTCODEPAGE
+                self.codepage = 'cp%d' % struct.unpack('<H', value)
+            elif id == 0x19:  #MODULENAME
+                module = {'name': value}
+            elif id == 0x1a:  #MODULESTREAMNAME
+                module['stream'] = value.decode(self.codepage)
+            elif id == 0x31:  #MODULEOFFSET
+                module['offset'], = struct.unpack('<I', value)
+            elif id == 0x2b:  #MODULE terminator
+                modules.append((module['name'], module['stream'], module['offset']))
+        return modules
+
+def decompress(data):
+    """Decompresses a compressed container (MS-OVBA 2.4.1)"""
+    if data[:1] != '\x01':
+        raise Exception('Invalid compressed container')
+    out = bytearray()
+    position = 1
+    while position < len(data):
+        header, = struct.unpack_from('<H', data, position)
+        end = min(position + (header & 0x0fff) + 3, len(data))
+        position += 2
+        if not header & 0x8000:  #uncompressed chunk
+            out.extend(data[position: position + 4096])
+            position += 4096
+            continue
+        chunk_start = len(out)
+        while position < end:
+            flags = ord(data[position])
+            position += 1
+            for bit in range(8):
+                if position >= end:
+                    break
+                if not flags & (1 << bit):
+                    out.append(data[position])
+                    position += 1
+                else:
+                    token, = struct.unpack_from('<H', data, position)
+                    position += 2
+                    bit_count = max((len(out) - chunk_start - 1).bit_length(), 4)
+                    offset = (token >> (16 - bit_count)) + 1
+                    length = (token & (0xffff >> bit_count)) + 3
+                    for i in range(length):
+                        out.append(out[-offset])
+    return str(out)
+
+        
+def CreateExcel():
+    #DispatchEx starts a new instance instead of attaching to a running one
+    return client.DispatchEx("Excel.Application")
 
 def make_dir(directory):
     if not os.path.isdir(directory):
@@ -109,39 +465,12 @@ def make_dir(directory):
     return directory
 
 def get_shortname(path):
-    start = path.rfind("\\") + 1
-    end = max(0, path.rfind(".", start))
-    return path[start: end or None]
+    return os.path.splitext(os.path.basename(path))[0]
     
 def get_extention(path):
     start = path.rfind('.')
     return '' if start == -1 else path[start:]
 
-def extract_zip(filename, folder, pattern_include, pattern_exclude):
-    p_inc = re.compile(pattern_include)
-    p_exc = re.compile(pattern_exclude)
-    with zipfile.ZipFile(filename, mode="r") as zip:
-        for name in zip.namelist():
-            if p_inc.match(name) and not p_exc.match(name):
-                dest_file = folder + '\\' + name
-                dest_dir = os.path.dirname(dest_file)
-                if not os.path.isdir(dest_dir):
-                    os.makedirs(dest_dir)
-                with open(dest_file , 'wb') as file:
-                    file.write(zip.read(name))
-  
-def build_zip(folder, filename, pattern_include, pattern_exclude):
-    p_inc = re.compile(pattern_include)
-    p_exc = re.compile(pattern_exclude)
-    with zipfile.ZipFile(filename, mode="w", compression=8) as zip:
-        for (dirpath, dirnames, filenames) in os.walk(folder):
-            for file in filenames:
-                abs_path = os.path.join(dirpath, file)
-                rel_path = os.path.relpath(abs_path, folder)
-                if p_inc.match(rel_path) and not p_exc.match(rel_path):
-                    zip.write(abs_path, rel_path)
-
-
 xlTemplate8 = 17
 xlWorkbook8 = 56
 xlOpenXMLWorkbookMacroEnabled = 52
@@ -158,6 +487,16 @@ extensions = {
     vbext_ct_MSForm : 'frm'
 }
 
+EXCEL_MAX_INSTANCES = 4
+
+#header written by the VBE for any VBA class module, the instancing being in VB_Exposed and VB_Creatable
+CLASS_HEADER = "VERSION 1.0 CLASS\r\nBEGIN\r\n  MultiUse = -1  'True\r\nEND\r\n"
+
+#attributes of a class module written by the VBE
+CLASS_ATTRIBUTES = ('VB_Name', 'VB_GlobalNameSpace', 'VB_Creatable', 'VB_PredeclaredId', 'VB_Exposed')
+
+MAXREGSECT = 0xfffffffa
+
 __dir__ = os.path.dirname(os.path.realpath(__file__))
 
 if __name__ == '__main__':
@@ -0,0 +1,57 @@
+using System;
+using System.Reflection;
+using System.Runtime.InteropServices;
+[assembly: AssemblyTitle("Selenium .Net/COM binding")]
+[assembly: AssemblyDescription("Selenium Type Library")]
+[assembly: ComVisible(false)]
+[assembly: Guid("0277FC34-FD1B-4616-BB19-A9AABCAF2A70")]
+[assembly: AssemblyVersion("2.0.9.0")]
+[assembly: AssemblyFileVersion("2.0.9.0")]
+[assembly: TypeLibVersion(2, 0)]
+namespace Selenium {
+    [AttributeUsage(AttributeTargets.All)] public class MarkAttribute : Attribute { public MarkAttribute(string s) {} }
+    [Guid("0277FC34-FD1B-4616-BB19-11660D7615B7"), ComVisible(true), InterfaceType(ComInterfaceType.InterfaceIsIDispatch)]
+    public interface _Manage { void A(); }
+    [Guid("0277FC34-FD1B-4616-BB19-0B61E370369D"), ComVisible(true), InterfaceType(ComInterfaceType.InterfaceIsDual)]
+    public interface _TableRow { int B { get; } }
+    [Guid("0277FC34-FD1B-4616-BB19-0B61E3703600"), ComVisible(true), InterfaceType((short)1)]
+    public interface _Unk { }
+    [Guid("0277FC34-FD1B-4616-BB19-0B61E3703601"), ComVisible(true)]
+    internal interface _Hidden { }
+    [Mark("x"), Description2("d"), Guid("0277FC34-FD1B-4616-BB19-E3CCFFAB4234"), ProgId("Selenium.WebDriver"), ComVisible(true), ClassInterface(ClassInterfaceType.None), ComDefaultInterface(typeof(_Manage))]
+    public class WebDriver : _Manage { public void A() {} public void X(int a) {} static WebDriver() {} }
+    [Guid("0277FC34-FD1B-4616-BB19-A34FCBA29598"), ProgId("Selenium.Utils"), ComVisible(true)]
+    public class Utils { public Utils(int a) {} public Utils() {} public static void S() {} }
+    [Guid("0277FC34-FD1B-4616-BB19-A34FCBA29599"), ProgId("Selenium.NoCtor"), ComVisible(true)]
+    public class NoCtor { internal NoCtor() {} }
+    [Guid("0277FC34-FD1B-4616-BB19-A34FCBA29500"), ProgId("Selenium.ParamCtor"), ComVisible(true)]
+    public class ParamCtor { public ParamCtor(string a) {} }
+    [Guid("0277FC34-FD1B-4616-BB19-A34FCBA29501"), ComVisible(false)]
+    public class Invisible { }
+    public class NoAttr { }
+    [Guid("0277FC34-FD1B-4616-BB19-300DAA508541"), ComVisible(true)]
+    public enum Strategy { None = 0, Class = 1 }
+    [Guid("0277FC34-FD1B-4616-BB19-300DAA508542"), ComVisible(true)]
+    public enum Small : byte { A }
+    [Guid("0277FC34-FD1B-4616-BB19-B342CE81CB2A"), ComVisible(true)]
+    public struct Point { public int X; public Point(int x) { X = x; } }
+    public class Outer {
+        [Guid("0277FC34-FD1B-4616-BB19-B342CE81CB2B"), ProgId("Selenium.Outer.Inner"), ComVisible(true)]
+        public class Inner { }
+        [Guid("0277FC34-FD1B-4616-BB19-B342CE81CB2C"), ProgId("Selenium.Outer.Priv"), ComVisible(true)]
+        private class Priv { }
+        [Guid("0277FC34-FD1B-4616-BB19-B342CE81CB2D"), ComVisible(true)]
+        public struct InnerStruct { }
+    }
+    [Guid("0277FC34-FD1B-4616-BB19-B342CE81CB2E"), ProgId("Selenium.Gen"), ComVisible(true)]
+    public class Gen<T> { }
+    [Guid("0277FC34-FD1B-4616-BB19-B342CE81CB2F"), ComVisible(true)]
+    public delegate void Callback(int a);
+    [Guid("0277FC34-FD1B-4616-BB19-B342CE81CB30"), ProgId("Selenium.Abs"), ComVisible(true)]
+    public abstract class Abs { public Abs() {} }
+    [AttributeUsage(AttributeTargets.All)] public class Description2Attribute : Attribute { public Description2Attribute(string s) {} }
+}
+namespace Other.Ns {
+    [Guid("0277FC34-FD1B-4616-BB19-B342CE81CB31"), ProgId("Other.Thing"), ComVisible(true)]
+    public class Thing { }
+}
@@ -0,0 +1,31 @@
+{
+ Code generated at each build by gen-registration.py
+ This is a subset of SeleniumBasicSetup.iss
+}
+
+lib.Guid := '{0277FC34-FD1B-4616-BB19-A9AABCAF2A70}';
+lib.FullName := 'Selenium, Version=2.0.9.0, Culture=neutral, PublicKeyToken=d499ab7f7ba4d827';
+lib.Description := 'Selenium Type Library';
+lib.TypeVersion := '2.0';
+lib.PathDll := ExpandConstant('{app}\Selenium.dll');
+lib.PathTlb32 := ExpandConstant('{app}\Selenium32.tlb');
+lib.PathTlb64 := ExpandConstant('{app}\Selenium64.tlb');
+lib.Runtime := 'v4.0.30319';
+
+RegTypeLib(lib);
+
+RegClass(lib, '{0277FC34-FD1B-4616-BB19-A34FCBA29598}', 'Selenium.Utils', 'Selenium.Utils');
+RegClass(lib, '{0277FC34-FD1B-4616-BB19-B342CE81CB2B}', 'Selenium.Outer.Inner', 'Selenium.Outer+Inner');
+RegClass(lib, '{0277FC34-FD1B-4616-BB19-B342CE81CB2E}', 'Selenium.Gen', 'Selenium.Gen`1');
+RegClass(lib, '{0277FC34-FD1B-4616-BB19-B342CE81CB30}', 'Selenium.Abs', 'Selenium.Abs');
+RegClass(lib, '{0277FC34-FD1B-4616-BB19-B342CE81CB31}', 'Other.Thing', 'Other.Ns.Thing');
+RegClass(lib, '{0277FC34-FD1B-4616-BB19-E3CCFFAB4234}', 'Selenium.WebDriver', 'Selenium.WebDriver');
+
+RegInterface(lib, '{0277FC34-FD1B-4616-BB19-0B61E3703600}', '_Unk', '{00020424-0000-0000-C000-000000000046}');
+RegInterface(lib, '{0277FC34-FD1B-4616-BB19-0B61E370369D}', '_TableRow', '{00020424-0000-0000-C000-000000000046}');
+RegInterface(lib, '{0277FC34-FD1B-4616-BB19-11660D7615B7}', '_Manage', '{00020420-0000-0000-C000-000000000046}');
+
+RegRecord(lib, '{0277FC34-FD1B-4616-BB19-300DAA508541}', 'Selenium.Strategy');
+RegRecord(lib, '{0277FC34-FD1B-4616-BB19-300DAA508542}', 'Selenium.Small');
+RegRecord(lib, '{0277FC34-FD1B-4616-BB19-B342CE81CB2A}', 'Selenium.Point');
+RegRecord(lib, '{0277FC34-FD1B-4616-BB19-B342CE81CB2D}', 'Selenium.Outer+InnerStruct');
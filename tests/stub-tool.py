@@ -0,0 +1,41 @@
+"""Stand-in for the build tools, to run build-setup.py without them
+Usage : python stub-tool.py <msbuild|tlbexp|iscc|python> arguments...
+Creates the files the tool would build and appends a line to the file in
+STUB_LOG with the tool, its arguments, and its start and end times.
+"""
+
+import os, re, sys, json, time
+
+OUTPUTS = {
+    'Selenium.csproj': ['Selenium/bin/Release/Selenium.dll', 'Selenium/bin/Release/Selenium.pdb',
+                        'Selenium/bin/Release/Selenium.xml'],
+    'VbsConsole.csproj': ['VbsConsole/bin/Release/vbsc.exe'],
+    'Selenium.shfbproj': ['Selenium/bin/Help/Selenium.chm'],
+    'build-addins.py': ['FirefoxAddons/bin/vb-formatters.xpi', 'FirefoxAddons/bin/implicit-wait.xpi']
+}
+
+def main(tool, args):
+    start = time.time()
+    outputs = []
+    for arg in args:
+        outputs.extend(OUTPUTS.get(os.path.basename(arg), []))
+        if arg.startswith('/out:'):
+            outputs.append(arg[5:])
+    if tool == 'python' and os.path.basename(args[0]) == 'gen-registration.py':
+        outputs.append(args[-1])
+    if tool == 'iscc':
+        with open(os.path.join('Selenium', 'Properties', 'AssemblyInfo.cs'), 'r') as f:
+            version = re.search(r'AssemblyFileVersion\("([.\d]+)"\)', f.read()).group(1)
+        outputs.append('SeleniumBasic-%s.exe' % version)
+    time.sleep(0.2)
+    for path in outputs:
+        if not os.path.isdir(os.path.dirname(path) or '.'):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(tool)
+    print 'Built by the %s stub' % tool
+    with open(os.environ['STUB_LOG'], 'a') as f:
+        f.write(json.dumps({'tool': tool, 'args': args, 'start': start, 'end': time.time()}) + '\n')
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,86 @@
+"""Runs build-setup.py on a copy of the project with stubs in place of the tools
+Usage : python -m unittest discover -s tests
+"""
+
+import os, re, sys, json, stat, shutil, zipfile, tempfile, subprocess, unittest
+
+CD = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(CD)
+
+TOOLS = {
+    'APP_MSBUILD_PATH': 'msbuild',
+    'APP_TLBEXP_PATH': 'tlbexp',
+    'APP_INNOSETUP_PATH': 'iscc',
+    'APP_PYTHON_PATH': 'python'
+}
+
+@unittest.skipIf(os.name == 'nt', 'The stubs are shell scripts')
+class BuildSetupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.project = os.path.join(self.dir, 'project')
+        shutil.copytree(PROJECT_DIR, self.project, ignore=shutil.ignore_patterns('.git', 'tests', '*.pyc'))
+        references = os.path.join(self.project, 'References')
+        if not os.path.isdir(references):
+            os.makedirs(references)
+        zipfile.ZipFile(os.path.join(references, 'selenium-ide.xpi'), 'w').close()
+        with open(os.path.join(self.project, 'Selenium', 'Properties', 'AssemblyInfo.cs'), 'r') as f:
+            #the add-ins are versioned with the current version, keep it for the second build
+            self.version = re.search(r'AssemblyFileVersion\("([.\d]+)"\)', f.read()).group(1)
+        self.log = os.path.join(self.dir, 'stub.log')
+        self.env = dict(os.environ, STUB_LOG=self.log, APP_SHFBROOT_DIR=self.dir)
+        for name, tool in TOOLS.items():
+            path = self.env[name] = os.path.join(self.dir, tool)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, os.path.join(CD, 'stub-tool.py'), tool))
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def build(self):
+        process = subprocess.Popen([sys.executable, os.path.join(self.project, 'build-setup.py'),
+            '--version', self.version, '--no-install', '--jobs', '4'], cwd=self.project, env=self.env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+        runs = []
+        if os.path.isfile(self.log):
+            with open(self.log, 'r') as f:
+                runs = [json.loads(line) for line in f]
+            os.remove(self.log)
+        return runs
+
+    def test_build(self):
+        runs = self.build()
+        def find(tool, arg):
+            return next(r for r in runs if r['tool'] == tool and any(a.endswith(arg) for a in r['args']))
+        library = find('msbuild', 'Selenium.csproj')
+        console = find('msbuild', 'VbsConsole.csproj')
+        for run in (find('tlbexp', '/win32'), find('tlbexp', '/win64'), find('msbuild', 'Selenium.shfbproj'),
+                find('python', 'gen-registration.py')):
+            self.assertGreaterEqual(run['start'], library['end'])
+            self.assertGreaterEqual(run['start'], console['end'])  #console rebuilds Selenium.dll
+        setup = find('iscc', 'SeleniumBasicSetup.iss')
+        self.assertEqual(setup['start'], max(r['start'] for r in runs))
+        self.assertTrue(os.path.isfile(os.path.join(self.project, 'SeleniumBasic-%s.exe' % self.version)))
+        with zipfile.ZipFile(os.path.join(self.project, 'FirefoxAddons', 'bin', 'extensions.xpi')) as zip:
+            self.assertEqual(sorted(zip.namelist()),
+                ['implicit-wait.xpi', 'install.rdf', 'selenium-ide.xpi', 'vb-formatters.xpi'])
+        with open(os.path.join(self.project, 'build-setup.log'), 'r') as f:
+            commands = [line for line in f if 'cmd> ' in line]
+        self.assertTrue(any(re.match(r'[\d:]+ \[Build documentation\] cmd> ', line) for line in commands))
+        self.assertTrue(all(re.match(r'[\d:]+ \[[^\]]+\] cmd> ', line) for line in commands))
+        #nothing packaged changed, every step is skipped
+        os.makedirs(os.path.join(self.project, 'References', '.cache'))
+        with open(os.path.join(self.project, 'References', '.cache', 'blob'), 'w') as f:
+            f.write('blob')
+        self.assertEqual(self.build(), [])
+        with open(os.path.join(self.project, 'References', 'chromedriver.exe'), 'w') as f:
+            f.write('exe')
+        self.assertEqual([r['tool'] for r in self.build()], ['iscc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+"""Tests of gen-registration.py on a fixture assembly
+The fixture Selenium.dll is built from Selenium.cs with Selenium.csproj and
+Selenium.pas is the registration expected from it, as listed by reflection.
+Usage : python -m unittest discover -s tests
+"""
+
+import os, imp, shutil, tempfile, unittest
+
+CD = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(CD, 'fixtures', 'registration')
+
+gr = imp.load_source('gen_registration', os.path.join(CD, '..', 'gen-registration.py'))
+
+class GenRegistrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_registration(self):
+        out_file = os.path.join(self.dir, 'Selenium.pas')
+        gr.main([os.path.join(FIXTURE_DIR, 'Selenium.dll'), out_file])
+        with open(os.path.join(FIXTURE_DIR, 'Selenium.pas'), 'rU') as file:
+            expected = file.read()
+        with open(out_file, 'rU') as file:
+            self.assertEqual(expected, file.read())
+
+if __name__ == '__main__':
+    unittest.main()
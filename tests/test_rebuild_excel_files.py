@@ -0,0 +1,136 @@
+"""Tests of rebuild_exel_files.py which run without Excel
+Usage : python -m unittest discover -s tests
+"""
+
+import os, sys, shutil, tempfile, unittest
+
+CD = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CD))
+
+import rebuild_exel_files as rx
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(CD), 'Examples', 'Excel')
+
+class FakeWorkbooks(list):
+
+    def Open(self, file):
+        self.append(FakeWorkbook(self))
+        return self[-1]
+
+class FakeWorkbook:
+
+    def __init__(self, workbooks):
+        self.workbooks = workbooks
+
+    def Close(self, save):
+        self.workbooks.remove(self)
+
+class FakeExcel:
+    """Application with the members used by the pool, counting the instances of its process"""
+
+    created = 0
+
+    def __init__(self):
+        FakeExcel.created += 1
+        self.Workbooks = FakeWorkbooks()
+
+    def Quit(self):
+        pass
+
+def open_workbook(xl, item):
+    if xl.Workbooks or xl.EnableEvents or xl.DisplayAlerts:
+        raise AssertionError('Application not reset')
+    xl.Workbooks.Open(item)  #left open, closed by the reset
+    open(os.path.join(DONE_DIR, item), 'w').close()
+    if item == 'break':
+        xl.Workbooks = None
+    elif item == 'fail':
+        raise ValueError(item)
+    elif item == 'crash':
+        os._exit(3)
+    return os.getpid(), id(xl), FakeExcel.created
+
+DONE_DIR = tempfile.mkdtemp()
+
+class ExcelPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        for name in os.listdir(DONE_DIR):
+            os.remove(os.path.join(DONE_DIR, name))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(DONE_DIR)
+
+    def test_applications_are_reused(self):
+        with rx.ExcelPool(2, FakeExcel) as pool:
+            results = pool.map(open_workbook, ['a', 'b', 'c', 'd', 'e', 'f'])
+        self.assertEqual(len(set(pid for pid, xl, created in results)), 2)
+        self.assertEqual(len(set((pid, xl) for pid, xl, created in results)), 2)
+        self.assertEqual(set(created for pid, xl, created in results), set([1]))
+
+    def test_broken_application_is_replaced(self):
+        with rx.ExcelPool(1, FakeExcel) as pool:
+            results = pool.map(open_workbook, ['a', 'break', 'b', 'c'])
+        self.assertEqual([created for pid, xl, created in results], [1, 1, 2, 2])
+
+    def test_error_raised_after_all_the_items(self):
+        with rx.ExcelPool(2, FakeExcel) as pool:
+            self.assertRaises(ValueError, pool.map, open_workbook, ['a', 'fail', 'b', 'c'])
+            self.assertEqual(sorted(os.listdir(DONE_DIR)), ['a', 'b', 'c', 'fail'])
+            results = pool.map(open_workbook, ['d', 'e'])
+        self.assertEqual(set(created for pid, xl, created in results), set([1]))
+
+    def test_crashed_worker_is_replaced(self):
+        with rx.ExcelPool(2, FakeExcel) as pool:
+            pids = set(pool.map(open_workbook, ['a', 'b', 'c', 'd'])[i][0] for i in range(4))
+            try:
+                pool.map(open_workbook, ['e', 'crash', 'f', 'g'])
+                self.fail('WorkerCrashed not raised')
+            except rx.WorkerCrashed as ex:
+                self.assertEqual(ex.__data__, ('crash', 3))
+            self.assertEqual(sorted(os.listdir(DONE_DIR)), ['a', 'b', 'c', 'crash', 'd', 'e', 'f', 'g'])
+            results = pool.map(open_workbook, ['h', 'i', 'j', 'k'])
+            self.assertTrue(all(p.is_alive() for p, jobs in pool.workers))
+        self.assertEqual(len(set(pid for pid, xl, created in results) - pids), 1)
+
+class ExportVbaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_class_module(self):
+        rx.export_vba(os.path.join(EXAMPLES_DIR, 'ExamplesPageObject.xlsm'), self.dir)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['Main.bas', 'PageHome.cls', 'PageLogin.cls', 'PageResult.cls'])
+        with open(os.path.join(self.dir, 'PageHome.cls'), 'rb') as file:
+            code = file.read()
+        self.assertTrue(code.startswith(
+            'VERSION 1.0 CLASS\r\n'
+            'BEGIN\r\n'
+            '  MultiUse = -1  \'True\r\n'
+            'END\r\n'
+            'Attribute VB_Name = "PageHome"\r\n'
+            'Attribute VB_GlobalNameSpace = False\r\n'
+            'Attribute VB_Creatable = False\r\n'
+            'Attribute VB_PredeclaredId = False\r\n'
+            'Attribute VB_Exposed = False\r\n'
+            '\r\n'
+            'Const url = '))
+
+    def test_round_trip(self):
+        #once imported, the VBE stores the class with the attributes it does not export
+        modules = rx.read_vba_modules(os.path.join(EXAMPLES_DIR, 'ExamplesPageObject.xlsm'))
+        files = dict(rx.get_vba_files(modules))
+        code = files['PageResult.cls'][len(rx.CLASS_HEADER):]
+        stored = code.replace('Attribute VB_GlobalNameSpace', 'Attribute VB_Base = "0{FCFB3D2A-A0FA-1068-A738-08002B3371B5}"\r\n'
+            'Attribute VB_GlobalNameSpace').replace('Attribute VB_Exposed = False\r\n', 'Attribute VB_Exposed = False\r\n'
+            'Attribute VB_TemplateDerived = False\r\nAttribute VB_Customizable = False\r\n')
+        self.assertNotEqual(stored, code)
+        self.assertEqual(rx.get_vba_files([('PageResult', rx.vbext_ct_ClassModule, stored)]), \
+            [('PageResult.cls', files['PageResult.cls'])])
+
+if __name__ == '__main__':
+    unittest.main()
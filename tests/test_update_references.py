@@ -0,0 +1,676 @@
+"""Tests of update-references.py which run without network access
+Usage : python -m unittest discover -s tests
+"""
+
+import os, re, sys, io, imp, time, shutil, tarfile, zipfile, tempfile, threading, unittest
+import requests
+
+CD = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CD))
+
+ur = imp.load_source('update_references', os.path.join(CD, '..', 'update-references.py'))
+
+class NullFile:
+
+    def write(self, text):
+        pass
+
+ur.Logger.lock = threading.Lock()
+ur.Logger.logfile = NullFile()
+
+class NullSession:
+
+    def bind(self, task):
+        pass
+
+class TaskExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        ur.Pipeline.default = ur.Pipeline(fetch=2, extract=1, write=1)
+        self.stderr, sys.stderr = sys.stderr, NullFile()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.dir)
+
+    def test_cancelled_task_does_not_write(self):
+        path = os.path.join(self.dir, 'file.txt')
+        cfg = ur.ConfigFile(os.path.join(self.dir, 'cfg.json'))
+        unwound = []
+        class Tasks:
+            def update_slow(self):
+                time.sleep(1.5)
+                try:
+                    with ur.Pipeline.default.stage('write'), open(path, 'w') as file:
+                        file.write('late')
+                finally:
+                    try:
+                        cfg.get('slow').update({'version': '1.0'})
+                    finally:
+                        unwound.append(True)
+        executor = ur.TaskExecutor(Tasks(), NullSession(), ur.Pipeline.default, timeout=0.5)
+        self.assertEqual(executor.run('^update_'), 1)
+        self.assertEqual(unwound, [True])  #joined before run returns
+        self.assertEqual(executor.results[0].status, 'timeout')
+        self.assertFalse(os.path.isfile(path))
+        self.assertEqual(cfg.get('slow'), {})
+
+    def test_results(self):
+        class Tasks:
+            def update_a(self):
+                return '1.0'
+            def update_b(self):
+                raise ValueError('failed')
+        executor = ur.TaskExecutor(Tasks(), NullSession(), ur.Pipeline.default)
+        self.assertEqual(executor.run('^update_'), 1)
+        results = dict((r.name, (r.status, r.version)) for r in executor.results)
+        self.assertEqual(results, {'update_a': ('done', '1.0'), 'update_b': ('failed', None)})
+
+    def test_longest_first(self):
+        history = ur.ConfigFile(os.path.join(self.dir, 'references.history.json'))
+        for name, duration in (('update_a', 1), ('update_b', 5), ('update_c', 3)):
+            history.get(name)['duration'] = duration
+        order = []
+        class Tasks:
+            pass
+        for name in ('update_a', 'update_b', 'update_c', 'update_new'):
+            setattr(Tasks, name, lambda self, name=name: order.append(name))
+        executor = ur.TaskExecutor(Tasks(), NullSession(), ur.Pipeline.default, history, workers=1)
+        self.assertEqual(executor.run('^update_'), 0)
+        self.assertEqual(order, ['update_new', 'update_b', 'update_c', 'update_a'])
+        self.assertEqual(history.get('update_new')['runs'], 1)  #recorded for the next run
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        ur.Pipeline.default = ur.Pipeline(fetch=2, extract=1, write=1)
+        self.stderr, sys.stderr = sys.stderr, NullFile()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.dir)
+
+    def get_stage(self):
+        return ur.Pipeline.default.stages.get(threading.current_thread())
+
+    def test_stages_move_forward(self):
+        stages = []
+        class Tasks:
+            def update_a(_):
+                stages.append(self.get_stage())
+                with ur.Pipeline.default.stage('extract'):
+                    stages.append(self.get_stage())
+                stages.append(self.get_stage())
+                with ur.Pipeline.default.stage('write'):
+                    stages.append(self.get_stage())
+                stages.append(self.get_stage())
+                with ur.Pipeline.default.stage('extract'):
+                    pass
+        executor = ur.TaskExecutor(Tasks(), NullSession(), ur.Pipeline.default)
+        self.assertEqual(executor.run('^update_'), 1)
+        self.assertEqual(stages, ['fetch', 'extract', None, 'write', None])
+        self.assertEqual(executor.results[0].status, 'failed')  #went back to extract
+        semaphores = ur.Pipeline.default.semaphores
+        self.assertEqual([semaphores[name]._Semaphore__value for name in ur.Pipeline.order], [2, 1, 1])
+
+    def test_fixed_pool(self):
+        threads = set()
+        class Tasks:
+            pass
+        for i in range(6):
+            setattr(Tasks, 'update_%d' % i, lambda self: threads.add(threading.current_thread()) or time.sleep(0.1))
+        executor = ur.TaskExecutor(Tasks(), NullSession(), ur.Pipeline.default, workers=2)
+        self.assertEqual(executor.run('^update_'), 0)
+        self.assertEqual(len(executor.threads), 2)
+        self.assertEqual(len(threads), 2)
+
+    def test_fetch_overlaps_extract(self):
+        pipeline = ur.Pipeline.default = ur.Pipeline(fetch=2, extract=2, write=1)
+        history = ur.ConfigFile(os.path.join(self.dir, 'history.json'))
+        starts = {}
+        class Tasks:
+            def update_a(_):
+                with pipeline.stage('extract'):
+                    time.sleep(1)
+            def update_b(_):
+                with pipeline.stage('extract'):
+                    time.sleep(1)
+            def update_c(_):
+                starts['c'] = time.time()
+        for name, duration in (('update_a', 3), ('update_b', 2), ('update_c', 1)):
+            history.get(name)['duration'] = duration  #queued last
+        start = time.time()
+        executor = ur.TaskExecutor(Tasks(), NullSession(), pipeline, history)
+        self.assertEqual(executor.run('^update_'), 0)
+        self.assertEqual(executor.workers, 5)
+        self.assertTrue(starts['c'] - start < 0.5)
+
+    def test_gzip_decompressed_in_extract_stage(self):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for name in ('pkg/a.txt', 'pkg/b.txt', 'pkg/c.bin'):
+                info = tarfile.TarInfo(name)
+                info.size = len(name)
+                tar.addfile(info, io.BytesIO(name))
+        cache = ur.HttpCache(os.path.join(self.dir, 'cache'), NullSession())
+        put, stages = cache.put, []
+        def put_in_stage(*args, **kwargs):
+            stages.append(self.get_stage())
+            return put(*args, **kwargs)
+        cache.put = put_in_stage
+        with ur.WebGZip('http://host/pkg.tar.gz', ArchiveSession(archive.getvalue()), cache) as gzip:
+            files = gzip.extract(r'.*\.txt$', self.dir)
+        self.assertEqual(stages, ['extract', 'extract'])
+        self.assertEqual(files, [os.path.join(self.dir, 'a.txt'), os.path.join(self.dir, 'b.txt')])
+        with open(os.path.join(self.dir, 'b.txt')) as file:
+            self.assertEqual(file.read(), 'pkg/b.txt')
+
+    def test_gzip_closed_after_member(self):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for name, data in (('pkg/webdriver.xpi', 'xpi'), ('pkg/tail.bin', os.urandom(0x200000))):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        session = ArchiveSession(archive.getvalue())
+        cache = ur.HttpCache(os.path.join(self.dir, 'cache'), session)
+        with ur.WebGZip('http://host/pkg.tar.gz', session, cache) as gzip:
+            with gzip.openfile(r'.*[\\/]webdriver\.xpi$') as file:
+                self.assertEqual(file.read(), 'xpi')
+            self.assertTrue(session.response.closed)
+            self.assertTrue(session.response.raw.tell() < 0x100000)  #tail not downloaded
+        with ur.WebGZip('http://host/pkg.tar.gz', session, cache) as gzip:
+            self.assertEqual(gzip.read(r'.*[\\/]webdriver\.xpi$').read(), 'xpi')
+        self.assertEqual(session.requests, 2)
+        self.assertEqual(session.response.raw.tell(), 0)  #served from the cache
+
+class ArchiveSession:
+
+    def __init__(self, data):
+        self.data = data
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        self.response = ArchiveResponse(self.data)
+        if 'If-None-Match' in kwargs.get('headers', {}):
+            self.response.status_code = 304
+        return self.response
+
+class ArchiveResponse:
+
+    status_code = 200
+    headers = {'etag': '"1"'}
+
+    def __init__(self, data):
+        self.raw = io.BytesIO(data)
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        return iter(lambda: self.raw.read(size), '')
+
+    def close(self):
+        self.closed = True
+
+class WebSourceTest(unittest.TestCase):
+
+    page = ''.join('<a href="/file-%d.%d.zip">\n' % (i / 10, i % 10) for i in range(20000))
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.session = PageSession(self.page)
+        self.cache = ur.HttpCache(os.path.join(self.dir, 'cache'), self.session)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_findfirst_is_kept(self):
+        source = ur.WebSource('http://host/page', self.cache)
+        self.assertEqual(source.findfirst(r'file-([\d.]+)\.zip'), '0.0')
+        self.assertEqual(source.findfirst(r'file-([\d.]+)\.zip', 0), 'file-0.0.zip')
+        self.assertEqual(self.session.requests, 1)
+        self.assertTrue(self.session.sent < len(self.page))  #closed on the first match
+
+    def test_findlastversion_is_kept(self):
+        source = ur.WebSource('http://host/page', self.cache)
+        pattern = r'file-([\d.]+)\.zip'
+        self.assertEqual(source.findlastversion(pattern, 0, 1), ('file-1999.9.zip', '1999.9'))
+        self.assertEqual(source.findfirst(pattern), '0.0')
+        self.assertEqual(self.session.requests, 1)
+        self.assertRaises(ur.PatternNotFound, source.findfirst, r'missing')
+        self.assertEqual(self.session.requests, 1)  #searched in the stored page
+
+class PageSession:
+
+    def __init__(self, page):
+        self.page = page
+        self.requests = self.sent = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        return PageResponse(self)
+
+class PageResponse:
+
+    status_code = 200
+    headers = {'etag': '"1"', 'content-type': 'text/html; charset=utf-8'}
+
+    def __init__(self, session):
+        self.raw = self
+        self.session = session
+        self.position = 0
+        self.closed = False
+
+    def stream(self, size, decode_content=True):
+        while not self.closed and self.position < len(self.session.page):
+            block = self.session.page[self.position:self.position + size]
+            self.position += len(block)
+            self.session.sent += len(block)
+            yield block
+
+    def tell(self):
+        return self.position
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class LockFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        ur.HttpCache.default = ur.HttpCache(os.path.join(self.dir, 'cache'), NullSession(), offline=True)
+        for name in ('a.dll', 'b.dll'):
+            with open(name, 'w') as file:
+                file.write(name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_existing_files_are_locked(self):
+        with ur.LockFile('lock.json') as locks:
+            locks.verify(2)
+            self.assertTrue(locks.check('http://host/a.zip', 'a.dll'))
+            self.assertFalse(locks.check('http://host/c.zip', 'c.dll'))
+        with ur.LockFile('lock.json') as locks:
+            self.assertEqual(locks.verify(2), [])
+            self.assertTrue(locks.check('http://host/a.zip', 'a.dll'))
+            self.assertEqual(locks.data['a.dll']['size'], 5)
+
+    def test_all_the_files_of_a_url_are_checked(self):
+        with ur.LockFile('lock.json') as locks:
+            locks.update('http://host/a.zip', 'a.dll', 'b.dll')
+        with open('b.dll', 'w') as file:
+            file.write('modified')
+        with ur.LockFile('lock.json') as locks:
+            self.assertEqual(locks.verify(2), ['b.dll'])
+            self.assertFalse(locks.check('http://host/a.zip', 'a.dll'))
+
+
+class FakeServer:
+    """Session serving in-memory resources.
+    Answers If-None-Match with a 304 and a Range with a 206 while If-Range
+    matches, like a web server. Without ranges, a Range is ignored.
+    """
+
+    def __init__(self, ranges=True):
+        self.ranges = ranges
+        self.resources = {}
+        self.errors = {}
+        self.requests = []
+        self.sent = 0
+
+    def add(self, url, body, **headers):
+        self.resources[url] = (body, dict((k.replace('_', '-'), v) for k, v in headers.items()))
+
+    def fail(self, url, status=None, cut=None, **headers):
+        """Queues a one-time error status or a body cut after some bytes"""
+        self.errors.setdefault(url, []).append((status, cut, \
+            dict((k.replace('_', '-'), v) for k, v in headers.items())))
+
+    def bind(self, task):
+        pass
+
+    def request(self, method, url, **kwargs):
+        return self.get(url, **kwargs)
+
+    def get(self, url, headers=None, stream=False, **kwargs):
+        headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.requests.append((url, headers))
+        status, cut, fields = self.errors[url].pop(0) if self.errors.get(url) else (None, None, {})
+        if status:
+            return FakeResponse(url, status, '', fields)
+        if url not in self.resources:
+            return FakeResponse(url, 404, '', {})
+        body, fields = self.resources[url]
+        fields = dict(fields)
+        validators = [fields.get('etag'), fields.get('last-modified')]
+        if fields.get('etag') and headers.get('If-None-Match') == fields['etag']:
+            return FakeResponse(url, 304, '', fields)
+        m = re.match(r'bytes=(\d*)-(\d*)$', headers.get('Range', ''))
+        if self.ranges and m and headers.get('If-Range', validators[0]) in validators:
+            start, end = m.groups()
+            if not start:
+                start, end = max(0, len(body) - int(end)), len(body) - 1
+            start, end = int(start), min(int(end or len(body) - 1), len(body) - 1)
+            if start >= len(body):
+                return FakeResponse(url, 416, '', {})
+            fields['content-range'] = 'bytes %d-%d/%d' % (start, end, len(body))
+            status, body = 206, body[start:end + 1]
+        else:
+            status = 200
+        fields['content-length'] = str(len(body))
+        self.sent += len(body) if cut is None else min(cut, len(body))
+        return FakeResponse(url, status, body, fields, cut)
+
+class FakeResponse:
+
+    def __init__(self, url, status_code, body, headers, cut=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.raw = FakeRaw(body, cut)
+        self.body = None
+
+    @property
+    def content(self):
+        if self.body is None:
+            self.body = self.raw.read()
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('%d for %s' % (self.status_code, self.url), response=self)
+
+    def iter_content(self, size):
+        return self.raw.stream(size)
+
+    def close(self):
+        self.raw.close()
+
+class FakeRaw:
+
+    def __init__(self, data, cut=None):
+        self.data = data
+        self.cut = cut
+        self.position = 0
+        self.closing = False
+
+    @property
+    def closed(self):
+        return self.closing or self.position >= len(self.data)
+
+    def read(self, size=-1, decode_content=True):
+        end = len(self.data) if size < 0 else self.position + size
+        if self.cut is not None:
+            if self.position >= self.cut:
+                raise IOError('Connection reset')
+            end = min(end, self.cut)
+        block = self.data[self.position:end]
+        self.position += len(block)
+        return block
+
+    def stream(self, size, decode_content=True):
+        while not self.closed:
+            yield self.read(size)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.closing = True
+
+class WebZipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        ur.Pipeline.default = ur.Pipeline(fetch=2, extract=1, write=1)
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip:
+            zip.writestr('pkg/head.bin', os.urandom(0x40000))
+            zip.writestr('pkg/driver.exe', 'driver' * 100)
+            zip.writestr('pkg/tail.bin', os.urandom(0x40000))
+        self.data = archive.getvalue()
+        self.server = FakeServer()
+        self.server.add('http://host/pkg.zip', self.data, etag='"1"')
+        self.cache = ur.HttpCache(os.path.join(self.dir, 'cache'), self.server)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def extract(self):
+        with ur.WebZip('http://host/pkg.zip', self.server, self.cache) as zip:
+            files = zip.extract(r'.*driver\.exe$', self.dir)
+        with open(files[0], 'rb') as file:
+            self.assertEqual(file.read(), 'driver' * 100)
+        return files
+
+    def test_ranges_read(self):
+        self.assertEqual(self.extract(), [os.path.join(self.dir, 'driver.exe')])
+        ranges = [headers['Range'] for url, headers in self.server.requests]
+        self.assertEqual(ranges[0], 'bytes=-%d' % ur.WebZip.tail_size)
+        self.assertTrue(re.match(r'bytes=\d+-\d+$', ranges[1]))
+        self.assertEqual(self.server.requests[1][1]['If-Range'], '"1"')
+        self.assertEqual(len(ranges), 2)
+        self.assertTrue(self.server.sent < 0x40000)  #neither head.bin nor the whole archive
+        self.extract()
+        self.assertEqual(len(self.server.requests), 3)  #same CRC, member served from the cache
+
+    def test_full_download_without_ranges(self):
+        self.server.ranges = False
+        self.extract()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.sent, len(self.data))
+        self.cache.offline = True
+        self.extract()
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class HttpCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = FakeServer()
+        self.server.add('http://host/file.bin', 'x' * 1000, etag='"1"')
+        self.retries = ur.DOWNLOAD_RETRIES
+
+    def tearDown(self):
+        ur.DOWNLOAD_RETRIES = self.retries
+        shutil.rmtree(self.dir)
+
+    def newcache(self, **kwargs):
+        return ur.HttpCache(os.path.join(self.dir, 'cache'), self.server, **kwargs)
+
+    def test_not_modified_revalidated(self):
+        entry = self.newcache().fetch('http://host/file.bin')
+        cache = self.newcache()
+        self.assertEqual(cache.fetch('http://host/file.bin'), entry)
+        url, headers = self.server.requests[-1]
+        self.assertEqual(headers['If-None-Match'], '"1"')
+        self.assertEqual(self.server.sent, 1000)  #304 without body
+        self.assertEqual(cache.read('http://host/file.bin'), 'x' * 1000)
+        self.assertEqual(len(self.server.requests), 2)  #revalidated once per run
+
+    def test_offline(self):
+        self.newcache().fetch('http://host/file.bin')
+        cache = self.newcache(offline=True)
+        self.assertEqual(cache.read('http://host/file.bin'), 'x' * 1000)
+        self.assertRaises(ur.NotInCache, cache.fetch, 'http://host/other.bin')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_least_recently_used_evicted(self):
+        cache = self.newcache(max_size=2500)
+        entries = [cache.put('http://host/%d.bin' % i, [str(i) * 1000]) for i in range(4)]
+        for i, entry in enumerate(entries):
+            path = cache.getblobpath(entry['digest'])
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+        cache.getblob(entries[0])  #used in this run
+        cache.evict()
+        kept = [i for i, entry in enumerate(entries) if os.path.isfile(cache.getblobpath(entry['digest']))]
+        self.assertEqual(kept, [0, 3])
+        self.assertEqual(cache.load('http://host/1.bin'), None)
+
+    def test_download_resumed_in_next_run(self):
+        ur.DOWNLOAD_RETRIES = 0
+        self.server.fail('http://host/file.bin', cut=300)
+        self.assertRaises(IOError, self.newcache().fetch, 'http://host/file.bin')
+        entry = self.newcache().fetch('http://host/file.bin')
+        self.assertEqual(entry['size'], 1000)
+        url, headers = self.server.requests[-1]
+        self.assertEqual((headers['Range'], headers['If-Range']), ('bytes=300-', '"1"'))
+        self.assertEqual(self.server.sent, 1000)
+        self.assertEqual(self.newcache().read('http://host/file.bin'), 'x' * 1000)
+
+    def test_download_resumed_after_retry(self):
+        self.server.fail('http://host/file.bin', cut=300)
+        self.assertEqual(self.newcache().read('http://host/file.bin'), 'x' * 1000)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[-1][1]['Range'], 'bytes=300-')
+
+    def test_download_restarted_if_modified(self):
+        ur.DOWNLOAD_RETRIES = 0
+        self.server.fail('http://host/file.bin', cut=300)
+        self.assertRaises(IOError, self.newcache().fetch, 'http://host/file.bin')
+        self.server.add('http://host/file.bin', 'y' * 800, etag='"2"')
+        self.assertEqual(self.newcache().read('http://host/file.bin'), 'y' * 800)
+        url, headers = self.server.requests[-1]
+        self.assertEqual(headers['If-Range'], '"1"')  #not satisfied, whole body sent
+        self.assertEqual(self.server.sent, 300 + 800)
+        self.assertEqual(self.newcache().fetch('http://host/file.bin')['etag'], '"2"')
+
+
+class WebBucketTest(unittest.TestCase):
+
+    url = 'http://bucket.host/'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = FakeServer()
+        self.cache = ur.HttpCache(os.path.join(self.dir, 'cache'), self.server)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def add_page(self, query, keys, truncated=False, marker=None):
+        contents = ''.join('<Contents><Key>%s</Key><Size>%d</Size><ETag>"%s"</ETag></Contents>' \
+            % (key, len(key), key) for key in keys)
+        self.server.add(self.url + query, '<?xml version="1.0" encoding="UTF-8"?>' \
+            '<ListBucketResult xmlns="http://doc.s3.amazonaws.com/2006-03-01">%s%s%s</ListBucketResult>' \
+            % ('<IsTruncated>%s</IsTruncated>' % str(truncated).lower(), \
+               '<NextMarker>%s</NextMarker>' % marker if marker else '', contents))
+
+    def test_pages_followed(self):
+        self.add_page('', ['2.1/driver.zip', '2.9/driver.zip'], True, '2.9/driver.zip')
+        self.add_page('?marker=2.9%2Fdriver.zip', ['2.10/driver.zip', '2.10/notes.txt'], True)
+        self.add_page('?marker=2.10%2Fnotes.txt', ['2.2/driver.zip'])
+        bucket = ur.WebBucket(self.url, self.cache)
+        keys = list(bucket.list())
+        self.assertEqual([k.key for k in keys], \
+            ['2.1/driver.zip', '2.9/driver.zip', '2.10/driver.zip', '2.10/notes.txt', '2.2/driver.zip'])
+        self.assertEqual(keys[0], ('2.1/driver.zip', 14, '2.1/driver.zip', None))
+        self.assertEqual(bucket.findlastversion(r'([\d.]+)/driver\.zip'), ('2.10/driver.zip', '2.10'))
+        self.assertEqual(len(self.server.requests), 3)  #pages fresh for the run
+
+    def test_prefix(self):
+        self.add_page('?prefix=2.1', ['2.1/driver.zip'])
+        bucket = ur.WebBucket(self.url, self.cache)
+        self.assertEqual([k.key for k in bucket.list('2.1')], ['2.1/driver.zip'])
+        self.assertRaises(ur.PatternNotFound, bucket.findlastversion, r'missing', prefix='2.1')
+
+
+class GitHubReleasesTest(unittest.TestCase):
+
+    url = 'https://api.github.com/repos/owner/driver/releases'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = FakeServer()
+        self.cache = ur.HttpCache(os.path.join(self.dir, 'cache'), self.server)
+        self.sleep, self.sleeps = time.sleep, []
+        time.sleep = self.sleeps.append
+
+    def tearDown(self):
+        time.sleep = self.sleep
+        shutil.rmtree(self.dir)
+
+    def add_page(self, url, versions, next=None):
+        releases = [{'tag_name': v, 'assets': [{'browser_download_url': \
+            'https://github.com/owner/driver/releases/download/v%s/driver-v%s-win32.zip' % (v, v)}]} \
+            for v in versions]
+        self.server.add(url, ur.json.dumps(releases), etag='"%s"' % url, \
+            link=next and '<%s>; rel="next", <%s>; rel="last"' % (next, next))
+
+    def test_next_page_followed(self):
+        self.add_page(self.url, ['1.0'], self.url + '?page=2')
+        self.add_page(self.url + '?page=2', ['0.10', '0.8'])
+        releases = ur.GitHubReleases('owner/driver', self.cache)
+        self.assertRaises(ur.PatternNotFound, releases.findlastversion, r'missing')
+        url, version = releases.findlastversion(r'driver-v(0\.\d+)-win32\.zip')
+        self.assertEqual(version, '0.10')
+        self.assertTrue(url.endswith('/v0.10/driver-v0.10-win32.zip'))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(releases.findlastversion(r'driver-v([\d.]+)-win32')[1], '1.0')
+        self.assertEqual(len(self.server.requests), 2)  #pages fresh for the run
+
+    def test_first_page_only(self):
+        self.add_page(self.url, ['0.9'], self.url + '?page=2')
+        releases = ur.GitHubReleases('owner/driver', self.cache)
+        self.assertEqual(releases.findlastversion(r'driver-v([\d.]+)-win32\.zip')[1], '0.9')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_rate_limit_waited(self):
+        self.add_page(self.url, ['0.9'])
+        self.server.fail(self.url, 403, x_ratelimit_remaining='0', x_ratelimit_reset=str(int(time.time()) + 30))
+        session = ur.WebSession()
+        session.local.session = self.server
+        releases = ur.GitHubReleases('owner/driver', ur.HttpCache(os.path.join(self.dir, 'cache'), session))
+        self.assertEqual(releases.findlastversion(r'driver-v([\d.]+)-win32\.zip')[1], '0.9')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertTrue(28 < self.sleeps[0] <= 30)
+
+    def test_long_rate_limit_not_waited(self):
+        self.add_page(self.url, ['0.9'])
+        self.server.fail(self.url, 429, retry_after=str(ur.RATE_LIMIT_MAX_WAIT + 1))
+        session = ur.WebSession()
+        session.local.session = self.server
+        releases = ur.GitHubReleases('owner/driver', ur.HttpCache(os.path.join(self.dir, 'cache'), session))
+        self.assertRaises(requests.HTTPError, releases.findlastversion, r'driver')
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.sleeps, [])
+        self.assertTrue(session.resets['api.github.com'] > time.time() + ur.RATE_LIMIT_MAX_WAIT - 1)
+
+
+class VersionNumberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(CD, 'fixtures', 'registration', 'Selenium.dll'), self.dir)
+        with open(os.path.join(self.dir, 'driver.exe'), 'wb') as file:
+            file.write('MZ' + '\0' * 0x100)
+        with open(os.path.join(self.dir, 'readme.txt'), 'w') as file:
+            file.write('readme')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_version_resource_read(self):
+        self.assertEqual(ur.get_version_number(os.path.join(self.dir, 'Selenium.dll')), '2.0.9.0')
+
+    def test_folder_versions(self):
+        self.assertEqual(ur.get_version_numbers(self.dir, 2), \
+            [('Selenium.dll', '2.0.9.0'), ('driver.exe', '0.0.0.0')])
+
+
+if __name__ == '__main__':
+    unittest.main()
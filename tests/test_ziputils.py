@@ -0,0 +1,58 @@
+"""Tests of ziputils.py
+Usage : python -m unittest discover -s tests
+"""
+
+import os, sys, shutil, tempfile, zipfile, unittest
+
+CD = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CD))
+
+import ziputils
+
+class RewriteZipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'source.zip')
+        with zipfile.ZipFile(self.source, 'w', zipfile.ZIP_DEFLATED) as zip:
+            zip.writestr('manifest.txt', 'a\nlinux\nb\n')
+            dll = zipfile.ZipInfo('lib/x86/file.dll')
+            dll.compress_type = zipfile.ZIP_DEFLATED
+            dll.flag_bits |= 0x08  #followed by a data descriptor
+            zip.writestr(dll, 'dll' * 1000)
+            zip.writestr('lib/linux/file.so', 'so' * 1000)
+            zip.writestr(zipfile.ZipInfo('stored.txt'), 'stored')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_rewrite_zip(self):
+        target = os.path.join(self.dir, 'target.zip')
+        ziputils.rewrite_zip(self.source, target, skip=r'\.so$', edits={
+            r'^manifest\.txt$': lambda data: data.replace('linux\n', '')
+        })
+        with zipfile.ZipFile(self.source) as zip_in, zipfile.ZipFile(target) as zip_out:
+            self.assertIsNone(zip_out.testzip())
+            self.assertEqual(['manifest.txt', 'lib/x86/file.dll', 'stored.txt'], zip_out.namelist())
+            self.assertEqual('a\nb\n', zip_out.read('manifest.txt'))
+            for name in ('lib/x86/file.dll', 'stored.txt'):
+                info_in, info_out = zip_in.getinfo(name), zip_out.getinfo(name)
+                self.assertEqual(zip_in.read(name), zip_out.read(name))
+                self.assertEqual(info_in.compress_type, info_out.compress_type)
+                self.assertEqual(info_in.compress_size, info_out.compress_size)
+                self.assertEqual(0, info_out.flag_bits & 0x08)
+
+    def test_copy_member_truncated(self):
+        with open(self.source, 'rb') as file:
+            data = file.read()
+        truncated = os.path.join(self.dir, 'truncated.zip')
+        with open(truncated, 'wb') as file:
+            file.write(data)
+        with zipfile.ZipFile(truncated) as zip_in:
+            info = zip_in.getinfo('lib/x86/file.dll')
+            info.compress_size = len(data)
+            with zipfile.ZipFile(os.path.join(self.dir, 'target.zip'), 'w') as zip_out:
+                self.assertRaises(zipfile.BadZipfile, ziputils.copy_member, zip_in, info, zip_out)
+
+if __name__ == '__main__':
+    unittest.main()
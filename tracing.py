@@ -0,0 +1,70 @@
+"""Spans of a run saved as Chrome trace events (chrome://tracing)
+Shared by build-setup.py and update-references.py.
+"""
+
+import os, time, json, threading, contextlib
+
+class Trace:
+    """Spans of the run saved as Chrome trace events"""
+
+    lock = threading.Lock()
+    events = []
+    threads = {}
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, category, **args):
+        start = time.time()
+        try:
+            yield args
+        finally:
+            Trace.add(name, category, start, time.time(), **args)
+
+    @staticmethod
+    def add(name, category, start, end, thread=None, **args):
+        thread = thread or threading.current_thread()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+            'ts': int(start * 1e6), 'dur': int((end - start) * 1e6), 'args': args}
+        with Trace.lock:
+            Trace.events.append(event)
+            Trace.threads[thread.ident] = thread.name
+
+    @staticmethod
+    def save(filepath):
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}} \
+            for tid, name in Trace.threads.items()]
+        with open(filepath, 'w') as file:
+            json.dump({'traceEvents': names + Trace.events, 'displayTimeUnit': 'ms'}, file)
+
+    @staticmethod
+    def summary(category, workers):
+        """Returns the critical path of the spans of a category, which are linked
+        by the names listed in their deps argument, the idle time of the workers
+        and the download throughput per host.
+        """
+        lines = []
+        spans = [e for e in Trace.events if e['cat'] == category]
+        end_of = lambda e: e['ts'] + e['dur']
+        if spans:
+            by_name = dict((e['name'], e) for e in spans)
+            path, span = [], max(spans, key=end_of)
+            while span:
+                path.insert(0, span)
+                deps = [by_name[name] for name in span['args'].get('deps', []) if name in by_name]
+                span = deps and max(deps, key=end_of) or None
+            wall = max(map(end_of, spans)) - min(e['ts'] for e in spans)
+            idle = workers * wall - sum(e['dur'] for e in spans)
+            lines.append('Critical path (%.1fs):' % ((end_of(path[-1]) - path[0]['ts']) / 1e6))
+            lines.extend('  %-32s %8.1fs' % (e['name'], e['dur'] / 1e6) for e in path)
+            lines.append('Idle worker time: %.1fs (%d workers over %.1fs)' % (idle / 1e6, workers, wall / 1e6))
+        hosts = {}
+        for e in Trace.events:
+            if e['cat'] == 'download':
+                size, duration = hosts.get(e['args']['host'], (0, 0))
+                hosts[e['args']['host']] = (size + e['args'].get('bytes', 0), duration + e['dur'])
+        if hosts:
+            lines.append('Download throughput:')
+        for host, (size, duration) in sorted(hosts.items()):
+            lines.append('  %-40s %10d bytes %8.1fs %8.1f KB/s' % (host, size, duration / 1e6, \
+                size / 1024.0 / max(duration / 1e6, 1e-3)))
+        return lines
@@ -2,13 +2,36 @@
 """Script to download the references used by the project
 """
 
-import sys, os, time, types, re, traceback, threading, io, datetime, csv, json, urllib, requests, zipfile, tarfile
-from win32api import GetFileVersionInfo, LOWORD, HIWORD
+import sys, os, time, types, re, traceback, threading, io, datetime, json, urllib, urlparse, argparse, contextlib, requests, zipfile, tarfile, hashlib, shutil, tempfile, struct, collections, mmap, multiprocessing, codecs
+from xml.etree import cElementTree as ElementTree
+from requests.packages.urllib3.exceptions import HTTPError as Urllib3Error
+from tracing import Trace
+from ziputils import rewrite_zip
 
 __dir__ = os.path.dirname(os.path.realpath(__file__))
 
-def main():
-    set_working_dir(__dir__ + r'\References\\')
+MAX_WORKERS = 10
+EXTRACT_WORKERS = multiprocessing.cpu_count()
+WRITE_WORKERS = 2
+HTTP_CONNECT_TIMEOUT = 15
+HTTP_READ_TIMEOUT = 120
+HOST_MAX_CONNECTIONS = 4
+TASK_TIMEOUT = 600
+CACHE_DIR = os.environ.get('SELENIUMBASIC_CACHE', os.path.join(__dir__, '.cache'))
+CACHE_MAX_SIZE = 1024 * 1024 * 1024
+DOWNLOAD_RETRIES = 3
+RATE_LIMIT_MAX_WAIT = 60
+GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Download the references used by the project')
+    parser.add_argument('--offline', action='store_true', help='Use only the downloads in the cache')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='Cache folder, can be shared')
+    parser.add_argument('--cache-size', type=int, default=CACHE_MAX_SIZE / 0x100000, help='Cache size in MB')
+    options = parser.parse_args(args)
+    options.cache_dir = os.path.abspath(options.cache_dir)
+    
+    set_working_dir(os.path.join(__dir__, 'References'))
     
     print __doc__
     print 'Last update : ' + file_datetime('references.json', format='%Y-%m-%d %H:%M:%S')
@@ -16,10 +39,29 @@ def main():
     
     Log('Update references ...')
     
+    WebSession.default = WebSession(MAX_WORKERS, (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    HttpCache.default = HttpCache(options.cache_dir, WebSession.default, \
+        max_size=options.cache_size * 0x100000, offline=options.offline)
+    Pipeline.default = Pipeline(fetch=MAX_WORKERS, extract=EXTRACT_WORKERS, write=WRITE_WORKERS)
+    
     #run tasks in parallel
-    with ConfigFile('references.json') as config:
-        tasks = Tasks(config)
-        exitcode = ParallelWorker(tasks).run(pattern='^update_')
+    with ConfigFile('references.json') as config, LockFile('references.lock.json') as locks, \
+            ConfigFile('references.history.json') as history:
+        invalid = locks.verify(MAX_WORKERS)
+        if invalid:
+            Log('Files missing or modified : ' + ', '.join(invalid))
+        tasks = Tasks(config, locks)
+        exitcode = TaskExecutor(tasks, WebSession.default, Pipeline.default, history).run(pattern='^update_')
+    
+    Log('File versions :')
+    for name, file_version in get_version_numbers('.'):
+        Log('  %-24s %s' % (name, file_version))
+    
+    HttpCache.default.evict()
+    
+    Trace.save(re.sub(r'\.[^.]+$', '.trace.json', __file__))
+    for line in Trace.summary('task', MAX_WORKERS):
+        Log(line)
     
     if exitcode:
         print '\nFailed!'
@@ -30,8 +72,9 @@ def main():
 
 class Tasks():
     
-    def __init__(self, configs):
+    def __init__(self, configs, locks):
         self.cfgs = configs
+        self.locks = locks
     
     def update_FirefoxDriver(self):
         page = r"https://pypi.python.org/pypi/selenium"
@@ -39,36 +82,27 @@ class Tasks():
         value, version = WebSource(page).findlastversion(pattern, group_value=0, group_version=1)
         url = r'https://pypi.python.org/packages/source/s/selenium/' + value
         cfg = self.cfgs.get('FirefoxDriver')
-        if cfg.get('version') != version or not file_exists('firefoxdriver.xpi'):
-            with WebGZip(url) as gzip:
-                #open the xpi file as a zip
-                xpi_bytes = gzip.read(r'.*\webdriver.xpi')
-                zip_in = zipfile.ZipFile(xpi_bytes)
-                zip_out = zipfile.ZipFile('firefoxdriver.xpi', mode='w', compression=0)
+        if cfg.get('version') != version or not self.locks.check(url, 'firefoxdriver.xpi'):
+            with WebGZip(url) as gzip, Trace.span('firefoxdriver.xpi', 'zip'):
                 #copy all the files except the linux ones and remove their references from the manifest
-                for fileinfo in zip_in.infolist():
-                    filename = fileinfo.filename
-                    if filename.endswith(r'chrome.manifest'): #edit manifest
-                        manifest_txt = zip_in.read(filename)
-                        manifest_txt = re.sub(r'^binary-component platform/Linux.*$\s*', \
-                            '', manifest_txt, flags=re.MULTILINE)
-                        zip_out.writestr(fileinfo, manifest_txt, compress_type=0)
-                    elif not filename.endswith('.so'): #skip linux files
-                        bytes = zip_in.read(filename)
-                        zip_out.writestr(fileinfo, bytes, compress_type=0)
-                zip_out.close()
-                zip_in.close()
+                with gzip.openfile(r'.*[\\/]webdriver\.xpi$') as xpi, Pipeline.default.stage('write'):
+                    rewrite_zip(xpi, 'firefoxdriver.xpi', skip=r'\.so$', edits={
+                        r'chrome\.manifest$': lambda text: re.sub(
+                            r'^binary-component platform/Linux.*$\s*', '', text, flags=re.MULTILINE)
+                    })
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, 'firefoxdriver.xpi')
             Log("Updated FirefoxDriver to version " + version)
+        return version
     
     def update_FirefoxPrefs(self):
         url = r"https://raw.githubusercontent.com/SeleniumHQ/selenium/master/javascript/firefox-driver/webdriver.json"
         version = WebSource(url).getEtag()
         cfg = self.cfgs.get('FirefoxPrefs')
-        if cfg.get('version') != version or not file_exists('firefox-prefs.js'):
+        if cfg.get('version') != version or not self.locks.check(url, 'firefox-prefs.js'):
             source = WebSource(url).gettext().decode('utf-8')
             content = json.loads(source)
-            with open("firefox-prefs.js", 'w') as file:
+            with Pipeline.default.stage('write'), open("firefox-prefs.js", 'w') as file:
                 for mainkey in ["frozen", "mutable"]:
                     mainobj = content[mainkey]
                     for key in sorted(mainobj.keys()):
@@ -80,64 +114,76 @@ class Tasks():
                         file.write(txt)
                     file.write('\n')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, 'firefox-prefs.js')
             Log("Updated FirefoxPrefs to version " + version)
+        return version
     
     def skip_SeleniumLibraries(self):
-        page = r"http://selenium-release.storage.googleapis.com"
-        pattern = r'<Key>([\d\.]+/selenium-dotnet-([\d\.]+).zip)'
-        value, version = WebSource(page).findlastversion(pattern, group_value=1, group_version=2)
-        url = page + '/' + value
+        page = r"http://selenium-release.storage.googleapis.com/"
+        pattern = r'^[\d\.]+/selenium-dotnet-([\d\.]+)\.zip$'
+        value, version = WebBucket(page).findlastversion(pattern)
+        url = page + value
         cfg = self.cfgs.get('.NetLibraries')
-        if cfg.get('version') != version or not file_exists('WebDriver.dll'):
+        if cfg.get('version') != version or not self.locks.check(url, 'WebDriver.dll', 'WebDriver.changelog.txt'):
             with WebZip(url) as zip:
-                zip.extract(r'^net35/.')
+                files = zip.extract(r'^net35/.')
             WebFile('http://selenium.googlecode.com/git/dotnet/CHANGELOG') \
                 .save('WebDriver.changelog.txt')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, 'WebDriver.changelog.txt', *files)
             Log("Updated Selenium .Net to version " + version)
+        return version
     
     def update_IE32(self):
         url = r"https://github.com/SeleniumHQ/selenium/raw/master/cpp/prebuilt/Win32/Release/IEDriverServer.exe"
         version = WebSource(url).getEtag()
         cfg = self.cfgs.get('IEDriver')
-        if cfg.get('version') != version or not file_exists('iedriver.exe'):
+        if cfg.get('version') != version or not self.locks.check(url, 'iedriver.exe'):
             WebFile(url).save('iedriver.exe')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, 'iedriver.exe')
             file_version = get_version_number(r'iedriver.exe')
             Log("Updated IE32 driver to version " + file_version)
+        return version
     
     def update_IE64(self):
         page = r"http://selenium-release.storage.googleapis.com/"
-        pattern = r'<Key>([\d\.]+/IEDriverServer_x64_([\d\.]+).zip)'
-        value, version = WebSource(page).findlastversion(pattern, group_value=1, group_version=2)
+        pattern = r'^[\d\.]+/IEDriverServer_x64_([\d\.]+)\.zip$'
+        value, version = WebBucket(page).findlastversion(pattern)
         url = page + value
         cfg = self.cfgs.get('IE64Driver')
-        if cfg.get('version') != version or not file_exists('iedriver64.exe'):
+        if cfg.get('version') != version or not self.locks.check(url, 'iedriver64.exe'):
             with WebZip(url) as zip:
-                zip.extract(r'IEDriverServer.exe', 'iedriver64.exe')
+                files = zip.extract(r'IEDriverServer.exe', 'iedriver64.exe')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, *files)
             Log("Updated IE64 driver to version " + version)
+        return version
     
     def update_SeleniumIDE(self):
         page = r'https://addons.mozilla.org/en-US/firefox/addon/selenium-ide/'
         pattern = r'https://addons.mozilla.org/firefox/downloads/file/\d+/selenium_ide-(\d\.\d\.\d)[^?"]+'
         url, version = WebSource(page).findlastversion(pattern, group_value=0, group_version=1)
         cfg = self.cfgs.get('SeleniumIDE')
-        if cfg.get('version') != version or not file_exists('selenium-ide.xpi'):
+        if cfg.get('version') != version or not self.locks.check(url, 'selenium-ide.xpi'):
             WebFile(url).save('selenium-ide.xpi')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, 'selenium-ide.xpi')
             Log("Updated Selenium IDE to version " + version)
+        return version
     
     def update_ChromeDriver(self):
         page = r"http://chromedriver.storage.googleapis.com/"
         version = WebSource(page + r'LATEST_RELEASE').gettext().strip()
         url = page + version + r'/chromedriver_win32.zip'
         cfg = self.cfgs.get('ChromeDriver')
-        if cfg.get('version') != version or not file_exists('chromedriver.exe'):
+        if cfg.get('version') != version or not self.locks.check(url, 'chromedriver.exe'):
             with WebZip(url) as zip:
-                zip.extract(r'chromedriver.exe')
+                files = zip.extract(r'chromedriver.exe')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, *files)
             Log("Updated Chrome driver to version " + version)
+        return version
     
     def update_PhantomJS(self):
         page = r'https://bitbucket.org/ariya/phantomjs/downloads/'
@@ -145,46 +191,50 @@ class Tasks():
         value, version = WebSource(page).findlastversion(pattern, group_value=0, group_version=1)
         url = page + value
         cfg = self.cfgs.get('PhantomJSDriver')
-        if cfg.get('version') != version or not file_exists('phantomjs.exe'):
+        if cfg.get('version') != version or not self.locks.check(url, 'phantomjs.exe'):
             with WebZip(url) as zip:
-                zip.extract(r'.*/phantomjs.exe')
+                files = zip.extract(r'.*/phantomjs.exe')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, *files)
             Log("Updated PhantomJS to version " + version)
+        return version
     
     def skip_Safari(self):
         page = r"http://selenium-release.storage.googleapis.com/"
-        pattern = r'<Key>(([\d\.]+)/SafariDriver.safariextz)'
-        value, version = WebSource(page).findlastversion(pattern, group_value=1, group_version=2)
+        pattern = r'^([\d\.]+)/SafariDriver\.safariextz$'
+        value, version = WebBucket(page).findlastversion(pattern)
         url = page + value
         cfg = self.cfgs.get('SafariDriver')
-        if cfg.get('version') != version or not file_exists('SafariDriver.safariextz'):
+        if cfg.get('version') != version or not self.locks.check(url, 'SafariDriver.safariextz'):
             WebFile(url).save('SafariDriver.safariextz')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, 'SafariDriver.safariextz')
             Log("Updated Safari driver to version " + version)
+        return version
     
     def update_Opera(self):
-        page = r'https://api.github.com/repos/operasoftware/operachromiumdriver/releases'
-        pattern = r'/v([\d\.]+)/operadriver_win32.zip'
-        value, version = WebSource(page).findlastversion(pattern, group_value=0, group_version=1)
-        url = r'https://github.com/operasoftware/operachromiumdriver/releases/download' + value
+        pattern = r'/v([\d\.]+)/operadriver_win32\.zip$'
+        url, version = GitHubReleases('operasoftware/operachromiumdriver').findlastversion(pattern)
         cfg = self.cfgs.get('OperaDriver')
-        if cfg.get('version') != version or not file_exists('operadriver.exe'):
+        if cfg.get('version') != version or not self.locks.check(url, 'operadriver.exe'):
             with WebZip(url) as zip:
-                zip.extract(r'operadriver.exe')
+                files = zip.extract(r'operadriver.exe')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, *files)
             Log("Updated Opera driver to version " + version)
+        return version
             
     def update_FirefoxWires(self):
-        page = r'https://api.github.com/repos/jgraham/wires/releases'
-        pattern = r'/([\d\.]+)/wires-[\d\.]+-windows.zip'
-        value, version = WebSource(page).findlastversion(pattern, group_value=0, group_version=1)
-        url = r'https://github.com/jgraham/wires/releases/download' + value
+        pattern = r'/([\d\.]+)/wires-[\d\.]+-windows\.zip$'
+        url, version = GitHubReleases('jgraham/wires').findlastversion(pattern)
         cfg = self.cfgs.get('FirefoxWiresDriver')
-        if cfg.get('version') != version or not file_exists('wires.exe'):
+        if cfg.get('version') != version or not self.locks.check(url, 'wires.exe'):
             with WebZip(url) as zip:
-                zip.extract(r'wires.exe')
+                files = zip.extract(r'wires.exe')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, *files)
             Log("Updated Firefox Wire driver to version " + version)
+        return version
     
     def skip_PdfSharp(self):
         page1 = r'http://sourceforge.net/projects/pdfsharp/files/pdfsharp'
@@ -195,11 +245,13 @@ class Tasks():
         value = WebSource(page2).findfirst(pattern)
         url = r'http://sunet.dl.sourceforge.net/project/pdfsharp/pdfsharp/' + value
         cfg = self.cfgs.get('PDFsharp')
-        if cfg.get('version') != version or not file_exists( 'PdfSharp.dll'):
+        if cfg.get('version') != version or not self.locks.check(url, 'PdfSharp.dll'):
             with WebZip(url) as zip:
-                zip.extract(r'.*/PdfSharp.dll')
+                files = zip.extract(r'.*/PdfSharp.dll')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, *files)
             Log("Updated PDF Sharp to version " + version)
+        return version
     
     def skip_DotNetZip(self):
         page = r'https://olex-secure.openlogic.com/packages/dotnetzip'
@@ -207,11 +259,13 @@ class Tasks():
         value, version = WebSource(page).findlastversion(pattern, group_value=0, group_version=1)
         url = urllib.unquote(value)
         cfg = self.cfgs.get('DotNetZip')
-        if cfg.get('version') != version or not file_exists('Ionic.Zip.dll'):
+        if cfg.get('version') != version or not self.locks.check(url, 'Ionic.Zip.dll'):
             with WebZip(url) as zip:
-                zip.extract(r'.*/Release/Ionic.Zip.dll')
+                files = zip.extract(r'.*/Release/Ionic.Zip.dll')
             cfg.update({'version': version, 'url': url})
+            self.locks.update(url, *files)
             Log("Updated DotNetZip to version " + version)
+        return version
 
 
 def set_working_dir(folder):
@@ -235,14 +289,79 @@ def format_ex(e_type, e_value, e_trace):
             lines.append('  ' + line.strip() + '\n')
     return '\n#%s:\n%s\n\n%s' %  (e_type.__name__, str(e_value), ''.join(lines))
 
+def get_host(url):
+    return urlparse.urlsplit(url).netloc
+
+def replace_file(src, dest):
+    if os.path.isfile(dest):
+        os.remove(dest)
+    os.rename(src, dest)
+
 def get_version_number(filename):
     try:
-    	info = GetFileVersionInfo(os.path.realpath(filename), "\\")
-    	ms = info['FileVersionMS']
-    	ls = info['FileVersionLS']
-    	return '.'.join([str(v) for v in (HIWORD(ms), LOWORD(ms), HIWORD(ls), LOWORD(ls))])
+        with open(filename, 'rb') as file:
+            view = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                ms, ls = read_file_version(view)
+            finally:
+                view.close()
+        return '.'.join([str(v) for v in (ms >> 16, ms & 0xffff, ls >> 16, ls & 0xffff)])
     except:
-    	return '0.0.0.0'
+        return '0.0.0.0'
+
+def get_version_numbers(folder='.', max_workers=MAX_WORKERS):
+    """Version number of each .exe and .dll of a folder, read in parallel"""
+    names = sorted(name for name in os.listdir(folder) if re.search(r'\.(exe|dll)$', name, re.I))
+    pool = ThreadPool(max_workers)
+    try:
+        versions = pool.map(get_version_number, [os.path.join(folder, name) for name in names])
+    finally:
+        pool.close()
+    return zip(names, versions)
+
+def read_file_version(view):
+    """Reads the file version of a PE image from the VS_FIXEDFILEINFO of its
+    RT_VERSION resource. Only the headers, the resource directory and the
+    version resource are read from the memory map.
+    """
+    if view[:2] != 'MZ':
+        raise ValueError('Not a PE file')
+    pe, = struct.unpack_from('<I', view, 0x3c)
+    if view[pe:pe + 4] != 'PE\0\0':
+        raise ValueError('Not a PE file')
+    section_count, optional_size = struct.unpack_from('<H12xH', view, pe + 6)
+    optional = pe + 24
+    magic, = struct.unpack_from('<H', view, optional)
+    directories = optional + (96 if magic == 0x10b else 112)
+    rsrc_rva, rsrc_size = struct.unpack_from('<II', view, directories + 2 * 8)
+    sections = []
+    for i in range(section_count):
+        sections.append(struct.unpack_from('<8xIIII', view, optional + optional_size + i * 40))
+
+    def offset(rva):
+        for virtual_size, address, raw_size, raw_offset in sections:
+            if address <= rva < address + max(virtual_size, raw_size):
+                return rva - address + raw_offset
+        raise ValueError('Invalid RVA %x' % rva)
+
+    def find_entry(directory, id=None):
+        named, ids = struct.unpack_from('<12xHH', view, directory)
+        for i in range(named + ids):
+            name, target = struct.unpack_from('<II', view, directory + 16 + i * 8)
+            if id is None or name == id:
+                return target
+        raise ValueError('No version resource')
+
+    root = offset(rsrc_rva)
+    target = find_entry(root, 16)  #RT_VERSION
+    while target & 0x80000000:  #sub directory: name, then language
+        target = find_entry(root + (target & 0x7fffffff))
+    data_rva, data_size = struct.unpack_from('<II', view, root + target)
+    start = offset(data_rva)
+    pos = view.find('\xbd\x04\xef\xfe', start, start + data_size)
+    if pos < 0:
+        raise ValueError('No VS_FIXEDFILEINFO')
+    return struct.unpack_from('<II', view, pos + 8)
 
 class ConfigFile(dict):
 
@@ -264,157 +383,1073 @@ class ConfigFile(dict):
 
     def get(self, key):
         with self.lock:
-            return self.data.setdefault(key, {})
+            entry = self.data.get(key)
+            if not isinstance(entry, ConfigEntry):
+                entry = self.data[key] = ConfigEntry(entry or {})
+            return entry
+
+class ConfigEntry(dict):
+    """Entry of a config file which a cancelled task can no longer update"""
+
+    def update(self, *args, **kwargs):
+        check_cancelled()
+        dict.update(self, *args, **kwargs)
+
+class LockFile:
+    """sha256, size and source ETag of each file produced by the tasks.
+    verify() hashes the locked files in parallel and a file is only valid if it
+    still has its recorded size and digest, otherwise the task downloads it again.
+    A task is checked only when its version matches references.json, so an
+    existing file missing from the lock is taken as is and added to it.
+    """
 
-from Queue import Queue
+    def __init__(self, filepath):
+        self.lock = threading.Lock()
+        self.filepath = filepath
+        self.valid = set()
+        if os.path.isfile(filepath):
+            with open(filepath, 'r') as file:
+                self.data = json.load(file)
+        else:
+            self.data = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with open(self.filepath, 'w') as file:
+            json.dump(self.data, file, sort_keys=True, indent=4)
+
+    def verify(self, max_workers=MAX_WORKERS):
+        names = [name for name, lock in self.data.items() \
+            if os.path.isfile(name) and os.path.getsize(name) == lock['size']]
+        pool = ThreadPool(max_workers)
+        try:
+            digests = pool.map(hash_file, names)
+        finally:
+            pool.close()
+        self.valid = set(name for name, digest in zip(names, digests) \
+            if digest == self.data[name]['sha256'])
+        return sorted(set(self.data) - self.valid)
+
+    def check(self, url, *filenames):
+        """Returns True if the files and all the others locked from the url are valid"""
+        with self.lock:
+            unlocked = [name for name in filenames if name not in self.data and os.path.isfile(name)]
+        if unlocked:
+            self.update(url, *unlocked)
+        with self.lock:
+            names = set(filenames).union(name for name, lock in self.data.items() if lock['url'] == url)
+            return names <= self.valid
+
+    def update(self, url, *filenames):
+        check_cancelled()
+        entry = HttpCache.default.load(url) or {}
+        for filename in filenames:
+            lock = {'sha256': hash_file(filename), 'size': os.path.getsize(filename), \
+                'etag': entry.get('etag'), 'url': url}
+            with self.lock:
+                self.data[filename] = lock
+                self.valid.add(filename)
+
+def hash_file(path):
+    """sha256 of a file read through a memory map, hashlib releases the GIL"""
+    with open(path, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            return hashlib.sha256().hexdigest()
+        view = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return hashlib.sha256(view).hexdigest()
+        finally:
+            view.close()
 
-class ParallelWorker(Queue):
+from Queue import Queue, Empty
+from multiprocessing.pool import ThreadPool
 
-    def __init__(self, instance, max_workers=10):
-        Queue.__init__(self)
+class TaskExecutor:
+    """Runs the tasks in threads and reports a result per task.
+    A fixed pool of workers runs the tasks, each task starting in the fetch
+    stage of the pipeline. There is one worker per slot of the pipeline by
+    default, so the fetch slots stay busy while other tasks decompress or
+    write their files.
+    The tasks are queued longest expected first from the durations of the
+    previous runs kept in history, the tasks without history being first.
+    A task running past its deadline is reported as timed out. Its HTTP responses
+    are closed to unblock its thread, its pipeline slot and its worker are replaced
+    and it is flagged as cancelled, so it fails at its next stage or update instead
+    of writing anything. The threads are joined before the run returns.
+    """
+
+    local = threading.local()
+
+    def __init__(self, instance, session, pipeline, history=None, timeout=TASK_TIMEOUT, workers=None):
         self.instance = instance
-        self.exitcode = 0
-        self.max_workers = max_workers
+        self.session = session
+        self.pipeline = pipeline
+        self.history = history
+        self.timeout = timeout
+        self.workers = workers or pipeline.size()
+        self.queue = Queue()
+        self.condition = threading.Condition()
 
     def __run__(self):
-        while not self.empty():
-            method = self.get()
+        while True:
+            self.pipeline.enter('fetch')
+            try:
+                method, result = self.queue.get_nowait()
+            except Empty:
+                self.pipeline.reset()
+                return
+            with self.condition:
+                result.status = 'running'
+                result.start = time.time()
+                result.thread = threading.current_thread()
+            self.session.bind(result)
+            TaskExecutor.local.task = result
             try:
-                method()
+                version, error = method(), None
             except Exception as ex:
-                self.exitcode = 1
                 e_type, e_value, e_trace = sys.exc_info()
-                sys.stderr.write(format_ex(e_type, e_value, e_trace.tb_next))
+                version, error = None, format_ex(e_type, e_value, e_trace.tb_next)
             finally:
-                self.task_done()
+                self.session.bind(None)
+                TaskExecutor.local.task = None
+                self.pipeline.reset()
                 sys.exc_clear()
+            with self.condition:
+                if result.status != 'running':
+                    return  #cancelled, replaced by another worker
+                result.finish(error and 'failed' or 'done', version)
+                if error:
+                    sys.stderr.write(error)
+                self.condition.notify()
+
+    def start_worker(self):
+        t = threading.Thread(target=self.__run__)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
 
     def run(self, pattern=''):
-        methods = [getattr(self.instance, k) for k, v in self.instance.__class__.__dict__.items() \
+        names = [k for k, v in self.instance.__class__.__dict__.items() \
             if isinstance(v, types.FunctionType) and re.search(pattern, k)]
-        nb_workers = min(self.max_workers, len(methods))
-        for method in methods:
-            self.put(method)
-        for i in range(nb_workers):
-            t = threading.Thread(target=self.__run__)
-            t.daemon = True
-            t.start()
-        self.join()
-        return self.exitcode
+        if self.history is not None:
+            names.sort(key=lambda name: -self.history.get(name).get('duration', float('inf')))
+        self.results = [TaskResult(name) for name in names]
+        for name, result in zip(names, self.results):
+            self.queue.put((getattr(self.instance, name), result))
+        self.threads = []
+        for i in range(min(self.workers, len(names))):
+            self.start_worker()
+        with self.condition:
+            while True:
+                running = [r for r in self.results if r.status == 'running']
+                if not running and all(r.status != 'queued' for r in self.results):
+                    break
+                for result in running:
+                    if time.time() - result.start > self.timeout:
+                        result.cancel()
+                        self.pipeline.leave(result.thread)
+                        self.start_worker()
+                        sys.stderr.write('\n#Timeout:\n%s() exceeded %ss\n' % (result.name, self.timeout))
+                self.condition.wait(1)
+        #a cancelled task can still be unwinding
+        for thread in self.threads:
+            thread.join()
+        self.report()
+        if self.history is not None:
+            self.record()
+        return int(any(r.status != 'done' for r in self.results))
+
+    def record(self):
+        """Averages the duration and the bytes of each task with the previous runs"""
+        for r in self.results:
+            if r.status == 'done':
+                stats = self.history.get(r.name)
+                runs = min(stats.get('runs', 0), 4)
+                stats['duration'] = (stats.get('duration', 0) * runs + r.duration) / (runs + 1)
+                stats['bytes'] = (stats.get('bytes', 0) * runs + r.bytes) / (runs + 1)
+                stats['runs'] = stats.get('runs', 0) + 1
+
+    def report(self):
+        Log('%-24s %-8s %9s %12s  %s' % ('Task', 'Status', 'Duration', 'Bytes', 'Version'))
+        for r in sorted(self.results, key=lambda r: r.name):
+            Log('%-24s %-8s %8.1fs %12d  %s' % (r.name, r.status, r.duration, r.bytes, r.version or ''))
+
+class Pipeline:
+    """Stages a task goes through in order, each with a limited number of slots:
+    fetch for the network, extract for the decompression and write for the disk.
+    A task leaves its slot in a stage before waiting for a slot in the next one,
+    so the downloads go on while other tasks decompress and write, and a full
+    stage holds back the tasks entering it. A task only moves forward and never
+    goes back to a stage it has passed.
+    """
+
+    default = None
+    order = ('fetch', 'extract', 'write')
+
+    def __init__(self, **slots):
+        self.slots = slots
+        self.semaphores = dict((name, threading.Semaphore(n)) for name, n in slots.items())
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.reached = {}
+
+    def enter(self, name):
+        thread = threading.current_thread()
+        with self.lock:
+            reached = self.reached.get(thread)
+        if reached and Pipeline.order.index(name) < Pipeline.order.index(reached):
+            raise PipelineError(name, reached)
+        self.leave()
+        self.semaphores[name].acquire()
+        with self.lock:
+            self.stages[thread] = self.reached[thread] = name
+        check_cancelled()
+
+    def size(self):
+        """Returns the number of slots of all the stages"""
+        return sum(self.slots.values())
+
+    def leave(self, thread=None):
+        with self.lock:
+            name = self.stages.pop(thread or threading.current_thread(), None)
+        if name:
+            self.semaphores[name].release()
+
+    def reset(self):
+        """Leaves the current stage at the end of a task"""
+        self.leave()
+        with self.lock:
+            self.reached.pop(threading.current_thread(), None)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        with self.lock:
+            current = self.stages.get(threading.current_thread())
+        if name == current:
+            yield
+            return
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.leave()
+
+class TaskResult:
+
+    def __init__(self, name):
+        self.name = name
+        self.status = 'queued'
+        self.start = None
+        self.duration = 0
+        self.bytes = 0
+        self.version = None
+        self.thread = None
+        self.cancelled = False
+        self.responses = []
+
+    def finish(self, status, version=None):
+        self.status = status
+        self.version = version
+        self.duration = time.time() - self.start
+        self.bytes = sum(raw.tell() for raw in self.responses)
+        self.responses = []
+        Trace.add(self.name, 'task', self.start, self.start + self.duration, self.thread, \
+            status=status, bytes=self.bytes, version=version)
+
+    def cancel(self):
+        self.cancelled = True
+        for raw in self.responses:
+            try:
+                raw.close()
+            except Exception:
+                pass
+        self.finish('timeout')
 
 class WebGZip:
+    """Remote tar.gz archive read as a stream.
+    The archive is read from the HTTP response in the fetch stage and each
+    requested member is decompressed in the extract stage. The response is
+    closed once the member is read, so only the head of the archive up to the
+    last requested member is downloaded.
+    Extracted members are stored in the cache and served from it as long as
+    the archive is not modified.
+    """
 
-    def __init__(self, url):
-        response = requests.get(url)
-        response.raise_for_status()
-        buffer = io.BytesIO(response.content)
-        self.tar = tarfile.open(fileobj=buffer, mode='r:gz')
+    def __init__(self, url, session=None, cache=None):
+        self.url = url
+        self.session = session or WebSession.default
+        self.cache = cache or HttpCache.default
+        self.response = self.tar = None
+        self.entry = self.cache.load(url)
+        if self.cache.offline:
+            if not self.entry:
+                raise NotInCache(url)
+        else:
+            self.open(self.entry)
+
+    def open(self, entry):
+        headers = dict(NO_ENCODING, **conditional_headers(entry))
+        self.response = self.session.get(self.url, headers=headers, stream=True)
+        if entry and self.response.status_code == 304:
+            self.response.close()
+            self.response = None
+            return
+        self.response.raise_for_status()
+        self.start = time.time()
+        self.entry = dict(get_validators(self.response), url=self.url, members=[])
+        self.cache.save_entry(self.url, self.entry)
+        self.tar = tarfile.open(fileobj=self.response.raw, mode='r|gz', bufsize=0x10000)
+
+    def close(self):
+        """Closes the response, the rest of the archive is not downloaded"""
+        if self.tar:
+            self.tar.close()
+            self.tar = None
+        if self.response:
+            Trace.add(self.url, 'download', self.start, time.time(), \
+                host=get_host(self.url), bytes=self.response.raw.tell())
+            self.response.close()
+            self.response = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.tar.close()
+        self.close()
 
-    def extract(self, pattern, dest = '.'):
+    def members(self, pattern):
+        """Yields the cache entries of the members matching the pattern"""
         p = re.compile(pattern)
+        if not self.tar:
+            entries = [self.cache.load(self.url + '#' + name) \
+                for name in self.entry.get('members', []) if p.match(name)]
+            if entries and all(entries):
+                for entry in entries:
+                    yield entry
+                return
+            if self.cache.offline:
+                raise NotInCache(self.url + '#' + pattern)
+            self.open(None)
+        while True:
+            tarinfo = self.tar.next()
+            if tarinfo is None:
+                return
+            if p.match(tarinfo.name) and tarinfo.isfile():
+                key = self.url + '#' + tarinfo.name
+                with Pipeline.default.stage('extract'), Trace.span(key, 'extract'):
+                    entry = self.cache.put(key, read_blocks(self.tar.extractfile(tarinfo)))
+                self.entry['members'].append(tarinfo.name)
+                self.cache.save_entry(self.url, self.entry)
+                yield entry
+
+    def first(self, pattern):
+        """Returns the first member matching the pattern and closes the response"""
+        for entry in self.members(pattern):
+            self.close()
+            return entry
+        raise PatternNotFound(pattern, self.url)
+
+    def extract(self, pattern, dest = '.'):
+        """Returns the paths of the files written"""
         destIsdir = os.path.isdir(dest)
-        for tarinfo in self.tar.getmembers():
-            name = tarinfo.name
-            if p.match(name) and not tarinfo.isdir():
-                dest_file = dest + '\\' + os.path.basename(name) if destIsdir else dest
-                with open(dest_file , 'wb') as file:
-                    file.write(self.tar.extractfile(tarinfo).read())
-                if not destIsdir:
-                    return
+        entries = list(self.members(pattern)) if destIsdir else [self.first(pattern)]
+        files = []
+        with Pipeline.default.stage('write'):
+            for entry in entries:
+                name = entry['url'].split('#', 1)[1]
+                dest_file = os.path.join(dest, os.path.basename(name)) if destIsdir else dest
+                shutil.copyfile(self.cache.getblob(entry), dest_file)
+                files.append(os.path.normpath(dest_file))
+        return files
     
     def read(self, pattern):
-        p = re.compile(pattern)
-        for tarinfo in self.tar.getmembers():
-            if p.match(tarinfo.name) and not tarinfo.isdir():
-                return self.tar.extractfile(tarinfo)
+        with open(self.cache.getblob(self.first(pattern)), 'rb') as file:
+            return io.BytesIO(file.read())
+
+    def openfile(self, pattern):
+        return open(self.cache.getblob(self.first(pattern)), 'rb')
 
 class WebZip:
+    """Remote zip archive.
+    The tail of the archive is requested first to read the central directory,
+    then only the byte range of each extracted member is requested.
+    Falls back to a download spooled to disk if the server ignores the Range header.
+    Extracted members are stored in the cache with their CRC and are not
+    requested again while the CRC listed in the central directory is the same.
+    """
 
-    def __init__(self, url):
-        response = requests.get(url)
-        response.raise_for_status()
-        buffer = io.BytesIO(response.content)
-        self.zip = zipfile.ZipFile(buffer)
+    tail_size = 0x10000 + zipfile.sizeEndCentDir
+
+    def __init__(self, url, session=None, cache=None):
+        self.url = url
+        self.cache = cache or HttpCache.default
+        self.file = self.zip = None
+        if self.cache.offline:
+            self.entry = self.cache.load(url)
+            if not self.entry:
+                raise NotInCache(url)
+            return
+        session = session or WebSession.default
+        headers = dict(NO_ENCODING, Range='bytes=-%d' % WebZip.tail_size)
+        with Trace.span(url, 'download', host=get_host(url)) as span:
+            response = session.get(url, headers=headers, stream=True)
+            response.raise_for_status()
+            if response.status_code == 206:
+                self.file = HttpRangeFile(session, response)
+            else:
+                self.file = spool_response(response)
+            span['bytes'] = response.raw.tell()
+        self.zip = zipfile.ZipFile(self.file)
+        self.entry = dict(get_validators(response), url=url, members=self.zip.namelist())
+        self.cache.save_entry(url, self.entry)
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.zip.close()
+        if self.zip:
+            self.zip.close()
+            self.file.close()
 
     def extract(self, pattern, dest='.'):
+        """Returns the paths of the files written"""
         p = re.compile(pattern)
         destIsdir = os.path.isdir(dest)
-        for name in self.zip.namelist():
-            if p.match(name):
-                dest_file = dest + '\\' + os.path.basename(name) if destIsdir else dest
-                with open(dest_file , 'wb') as file:
-                    file.write(self.zip.read(name))
-                if not destIsdir:
-                    return
+        names = [name for name in self.entry['members'] if p.match(name)]
+        entries = [(name, self.getmember(name)) for name in (names if destIsdir else names[:1])]
+        files = []
+        with Pipeline.default.stage('write'):
+            for name, entry in entries:
+                dest_file = os.path.join(dest, os.path.basename(name)) if destIsdir else dest
+                shutil.copyfile(self.cache.getblob(entry), dest_file)
+                files.append(os.path.normpath(dest_file))
+        return files
+
+    def getmember(self, name):
+        key = self.url + '#' + name
+        entry = self.cache.load(key)
+        if not self.zip:
+            if not entry:
+                raise NotInCache(key)
+            return entry
+        info = self.zip.getinfo(name)
+        if entry and entry.get('crc') == info.CRC:
+            return entry
+        if isinstance(self.file, HttpRangeFile):
+            self.file.prefetch(info.header_offset, info.header_offset + zipfile.sizeFileHeader \
+                + len(info.orig_filename) + len(info.extra) + info.compress_size + 0x400)
+        with Pipeline.default.stage('extract'), Trace.span(key, 'extract'), self.zip.open(info) as src:
+            return self.cache.put(key, read_blocks(src), crc=info.CRC)
+
+class HttpRangeFile:
+    """Read-only file object over HTTP.
+    Holds a single block in memory and requests the missing ones with Range.
+    """
+
+    min_block_size = 0x10000
+
+    def __init__(self, session, response):
+        self.session = session
+        self.url = response.url
+        self.etag = response.headers.get('etag')
+        start, end, size = re.match(r'bytes (\d+)-(\d+)/(\d+)', \
+            response.headers['content-range']).groups()
+        self.size = int(size)
+        self.position = 0
+        self.block_start = int(start)
+        self.block = response.content
+
+    def close(self):
+        self.block = ''
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size < 0 else min(self.size, self.position + size)
+        if self.position < self.block_start or end > self.block_start + len(self.block):
+            self.prefetch(self.position, max(end, self.position + self.min_block_size))
+        offset = self.position - self.block_start
+        data = self.block[offset: offset + end - self.position]
+        self.position += len(data)
+        return data
+
+    def prefetch(self, start, end):
+        end = min(end, self.size)
+        headers = dict(NO_ENCODING, Range='bytes=%d-%d' % (start, end - 1))
+        if self.etag:
+            headers['If-Range'] = self.etag
+        with Trace.span(self.url, 'download', host=get_host(self.url), range=headers['Range']) as span:
+            response = self.session.get(self.url, headers=headers)
+            span['bytes'] = len(response.content)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError('Range request not satisfied for %s' % self.url)
+        self.block_start = start
+        self.block = response.content
+
+def spool_response(response):
+    file = tempfile.TemporaryFile()
+    try:
+        for block in response.iter_content(0x100000):
+            file.write(block)
+    finally:
+        response.close()
+    file.seek(0)
+    return file
                     
 class WebFile:
 
-    def __init__(self, url):
+    def __init__(self, url, cache=None):
         self.url = url
+        self.cache = cache or HttpCache.default
 
     def save(self, file):
-        response = requests.get(self.url, stream=True)
-        response.raise_for_status()
-        with open(file, 'wb') as handle:
-            for block in response.iter_content(1024):
-                if not block:
-                    break
-                handle.write(block)
+        self.cache.copy(self.url, file)
 
 
 class WebSource:
 
-    def __init__(self, url):
+    def __init__(self, url, cache=None):
         self.url = url
+        self.cache = cache or HttpCache.default
         self.text = None
 
     def gettext(self):
         if self.text is None:
-            self.text = requests.get(self.url).text
+            self.text = self.cache.gettext(self.url)
         return self.text
 
     def findfirst(self, pattern, group=-1):
-        res = re.search(pattern, self.gettext())
-        if not res:
-            raise PatternNotFound(pattern, self.url)
-        return res.group(res.re.groups if group == -1 else group)
+        """Searches the page while it is received and closes it on the first match"""
+        for groups in self.cache.search(self.url, pattern, first=True):
+            return groups[len(groups) - 1 if group == -1 else group]
+        raise PatternNotFound(pattern, self.url)
 
     def getEtag(self, default='none'):
         try:
-            etag = requests.head(self.url).headers['etag']
+            etag = self.cache.fetch(self.url)['etag']
             return re.search(r'[\w-]+', etag).group(0)
         except:
             return default
 
     def findlastversion(self, pattern, group_value=1, group_version=2):
-        match = re.finditer(pattern, self.gettext())
-        lst_versions = [(m.group(group_value), m.group(group_version), \
-            map(int, m.group(group_version).split('.'))) for m in match]
-        if not lst_versions:
+        """Searches the page while it is received and keeps the highest version"""
+        last, last_version = None, None
+        for groups in self.cache.search(self.url, pattern):
+            version = map(int, groups[group_version].split('.'))
+            if last is None or version > last_version:
+                last, last_version = (groups[group_value], groups[group_version]), version
+        if last is None:
             raise PatternNotFound(pattern, self.url)
-        lst_versions.sort(key=lambda m: m[2], reverse=True)
-        return (lst_versions[0][0], lst_versions[0][1])
-
-    def findlastdate(self, pattern, group_value=1, group_datetime=2, datetime_format='%Y-%m-%dT%H:%M:%S'):
-        match = re.finditer(pattern, self.gettext())
-        lst_dates = [(m.group(group_value), time.strptime(m.group(group_datetime), datetime_format) \
-            ) for m in match]
-        if not lst_dates:
+        return last
+
+BucketKey = collections.namedtuple('BucketKey', 'key size etag modified')
+
+class WebBucket:
+    """Listing of a Google Storage bucket.
+    The pages of keys are requested by following the markers and each page is
+    parsed incrementally, so the keys are yielded as they are read.
+    """
+
+    def __init__(self, url, cache=None):
+        self.url = url
+        self.cache = cache or HttpCache.default
+
+    def list(self, prefix=None):
+        marker = None
+        while True:
+            params = [(k, v) for k, v in (('prefix', prefix), ('marker', marker)) if v]
+            url = self.url + ('?' + urllib.urlencode(params) if params else '')
+            truncated, marker, key = False, None, None
+            with open(self.cache.getblob(self.cache.fetch(url)), 'rb') as file:
+                for event, elem in ElementTree.iterparse(file):
+                    tag = elem.tag.rsplit('}', 1)[-1]
+                    if tag == 'Contents':
+                        fields = dict((e.tag.rsplit('}', 1)[-1], e.text) for e in elem)
+                        key = fields['Key']
+                        yield BucketKey(key, int(fields.get('Size') or 0), \
+                            (fields.get('ETag') or '').strip('"'), fields.get('LastModified'))
+                        elem.clear()
+                    elif tag == 'IsTruncated':
+                        truncated = elem.text == 'true'
+                    elif tag == 'NextMarker':
+                        marker = elem.text
+            if not truncated:
+                return
+            marker = marker or key
+
+    def findlastversion(self, pattern, group_version=1, prefix=None):
+        p = re.compile(pattern)
+        last, last_version = None, None
+        for record in self.list(prefix):
+            m = p.search(record.key)
+            if m:
+                version = map(int, m.group(group_version).split('.'))
+                if last is None or version > last_version:
+                    last, last_version = m, version
+        if last is None:
             raise PatternNotFound(pattern, self.url)
-        lst_dates.sort(key=lambda m: m[1], reverse=True)
-        return lst_dates[0]
+        return (last.group(0), last.group(group_version))
+
+class GitHubReleases:
+    """Releases of a GitHub repository read from the REST API.
+    The pages are requested through the cache, so an unchanged page costs a
+    304 which does not count against the rate limit. The releases are listed
+    from the newest and the next page is only requested while no asset matches.
+    """
+
+    def __init__(self, repo, cache=None):
+        self.url = 'https://api.github.com/repos/%s/releases' % repo
+        self.cache = cache or HttpCache.default
+
+    def pages(self):
+        url = self.url
+        while url:
+            entry = self.cache.fetch(url)
+            with open(self.cache.getblob(entry), 'rb') as file:
+                yield json.load(file)
+            links = requests.utils.parse_header_links(entry.get('link') or '')
+            url = next((link['url'] for link in links if link.get('rel') == 'next'), None)
+
+    def findlastversion(self, pattern, group_version=1):
+        p = re.compile(pattern)
+        for releases in self.pages():
+            matches = [p.search(asset['browser_download_url']) \
+                for release in releases for asset in release.get('assets', [])]
+            matches = [m for m in matches if m]
+            if matches:
+                last = max(matches, key=lambda m: map(int, m.group(group_version).split('.')))
+                return (last.string, last.group(group_version))
+        raise PatternNotFound(pattern, self.url)
+
+NO_ENCODING = {'Accept-Encoding': 'identity'}
+
+class WebSession:
+    """HTTP session shared by all the tasks.
+    Each thread gets its own requests.Session but all of them are mounted on
+    the same adapters, so a keep-alive connection to a host is reused by every
+    task and every request instead of paying a new TCP+TLS handshake.
+    A host answering that its rate limit is exceeded is not requested again
+    before the reset time, and the request is retried once if the wait is short.
+    """
+
+    default = None
+
+    def __init__(self, pool_size=MAX_WORKERS, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), \
+            host_connections=HOST_MAX_CONNECTIONS):
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.resets = {}
+        #pool_block limits the number of concurrent connections per host
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, \
+            pool_maxsize=min(pool_size, host_connections), pool_block=True, max_retries=2)
+
+    def bind(self, task):
+        self.local.task = task
+
+    def getsession(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self.local.session = session
+        return session
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        host = get_host(url)
+        if GITHUB_TOKEN and host == 'api.github.com':
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, Authorization='token ' + GITHUB_TOKEN)
+        for attempt in range(2):
+            with self.lock:
+                delay = self.resets.get(host, 0) - time.time()
+            if 0 < delay <= RATE_LIMIT_MAX_WAIT:
+                time.sleep(delay)
+            response = self.getsession().request(method, url, **kwargs)
+            delay = get_rate_limit_delay(response)
+            if delay is None:
+                break
+            with self.lock:
+                self.resets[host] = time.time() + delay
+            if attempt or delay > RATE_LIMIT_MAX_WAIT:
+                break
+            response.close()
+        return self.track(response)
+
+    def track(self, response):
+        task = getattr(self.local, 'task', None)
+        if task:
+            task.responses.append(response.raw)
+        return response
+
+class HttpCache:
+    """Persistent HTTP cache revalidated with If-None-Match/If-Modified-Since.
+    The bodies are stored as blobs named by their sha256 digest and an index maps
+    each url (or url#member for an archive member) to a digest and its validators.
+    An entry is revalidated once per run, a 304 response is served from disk.
+    Concurrent callers on the same url wait on the same request, and the
+    decoded text and the matches of each pattern are shared for the whole run.
+    The least recently used blobs are evicted once the store exceeds max_size.
+    In offline mode every request is served from the store.
+    """
+
+    default = None
+
+    def __init__(self, directory, session=None, max_size=CACHE_MAX_SIZE, offline=False):
+        self.directory = directory
+        self.session = session or WebSession.default
+        self.max_size = max_size
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        self.fresh = set()
+        self.texts = {}
+        self.matches = {}
+        for folder in ('blobs', 'index'):
+            if not os.path.isdir(os.path.join(directory, folder)):
+                os.makedirs(os.path.join(directory, folder))
+
+    def getlock(self, url):
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.RLock())
+
+    def getindexpath(self, key):
+        return os.path.join(self.directory, 'index', hashlib.sha1(key).hexdigest() + '.json')
+
+    def getblobpath(self, digest):
+        return os.path.join(self.directory, 'blobs', digest[:2], digest)
+
+    def getblob(self, entry):
+        path = self.getblobpath(entry['digest'])
+        os.utime(path, None)  #mark as recently used
+        return path
+
+    def load(self, key):
+        index_path = self.getindexpath(key)
+        if not os.path.isfile(index_path):
+            return None
+        with open(index_path, 'r') as file:
+            entry = json.load(file)
+        if 'digest' in entry and not os.path.isfile(self.getblobpath(entry['digest'])):
+            return None
+        return entry
+
+    def save_entry(self, key, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'index'))
+        with os.fdopen(fd, 'w') as file:
+            json.dump(entry, file, indent=4)
+        replace_file(tmp_path, self.getindexpath(key))
+
+    def put(self, key, blocks, **fields):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'blobs'))
+        with os.fdopen(fd, 'wb') as file:
+            for block in blocks:
+                file.write(block)
+        return self.put_file(key, tmp_path, **fields)
+
+    def put_file(self, key, path, **fields):
+        sha256, size = hashlib.sha256(), 0
+        with open(path, 'rb') as file:
+            for block in read_blocks(file):
+                sha256.update(block)
+                size += len(block)
+        digest = sha256.hexdigest()
+        blob_path = self.getblobpath(digest)
+        if os.path.isfile(blob_path):
+            os.remove(path)
+        else:
+            if not os.path.isdir(os.path.dirname(blob_path)):
+                os.makedirs(os.path.dirname(blob_path))
+            replace_file(path, blob_path)
+        entry = dict(fields, url=key, digest=digest, size=size)
+        self.save_entry(key, entry)
+        return entry
+
+    def fetch(self, url):
+        with self.getlock(url):
+            entry = self.load(url)
+            if entry and 'digest' not in entry:
+                entry = None
+            if self.offline:
+                if not entry:
+                    raise NotInCache(url)
+                return entry
+            if entry and url in self.fresh:
+                return entry
+            if entry:
+                start = time.time()
+                response = self.session.get(url, headers=conditional_headers(entry), stream=True)
+                if response.status_code == 304:
+                    response.close()
+                    Trace.add(url, 'download', start, time.time(), host=get_host(url), \
+                        bytes=response.raw.tell(), status=304)
+                    entry['etag'] = response.headers.get('etag', entry.get('etag'))
+                    self.save_entry(url, entry)
+                else:
+                    entry = self.download(url, response, start)
+            else:
+                entry = self.download(url)
+            self.fresh.add(url)
+            return entry
+
+    def download(self, url, response=None, start=None):
+        """Downloads to a .part file which is resumed with a Range request after
+        a failure, in this run or in the next one if the validators still match.
+        The span starts with the request of the response given, if any.
+        """
+        span = {'host': get_host(url), 'bytes': 0}
+        start = start or time.time()
+        try:
+            entry = self.download_part(url, response)
+            span['bytes'] = entry['size']
+            return entry
+        finally:
+            Trace.add(url, 'download', start, time.time(), **span)
+
+    def download_part(self, url, response):
+        part_path = os.path.join(self.directory, 'blobs', hashlib.sha1(url).hexdigest() + '.part')
+        part = None
+        if response is None and os.path.isfile(part_path) and os.path.isfile(part_path + '.json'):
+            with open(part_path + '.json', 'r') as file:
+                part = json.load(file)
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            if response is None:
+                headers = {}
+                if part and not part.get('content-encoding') and (part.get('etag') or part.get('last-modified')):
+                    headers = dict(NO_ENCODING, Range='bytes=%d-' % os.path.getsize(part_path))
+                    headers['If-Range'] = part.get('etag') or part.get('last-modified')
+                response = self.session.get(url, headers=headers, stream=True)
+            try:
+                if response.status_code == 416:
+                    part = None  #the part is complete or invalid, restart
+                    continue
+                response.raise_for_status()
+                if response.status_code != 206:
+                    part = dict(get_validators(response, 'content-type', 'content-encoding', 'link'), url=url)
+                    part['size'] = not part['content-encoding'] and response.headers.get('content-length')
+                    with open(part_path + '.json', 'w') as file:
+                        json.dump(part, file, indent=4)
+                with open(part_path, 'ab' if response.status_code == 206 else 'wb', 0x100000) as file:
+                    receive(response, file)
+                if part['size'] and os.path.getsize(part_path) != int(part['size']):
+                    raise IOError('Incomplete download of %s' % url)
+                break
+            except requests.HTTPError:
+                raise
+            except (IOError, Urllib3Error) as ex:
+                if attempt == DOWNLOAD_RETRIES:
+                    raise
+            finally:
+                response.close()
+                response = None
+        else:
+            raise IOError('Failed to download %s' % url)
+        os.remove(part_path + '.json')
+        fields = dict((k, part.get(k)) for k in ('etag', 'last-modified', 'content-type', 'link'))
+        return self.put_file(url, part_path, **fields)
+
+    def read(self, url):
+        with open(self.getblob(self.fetch(url)), 'rb') as file:
+            return file.read()
+
+    def gettext(self, url):
+        with self.getlock(url):
+            text = self.texts.get(url)
+            if text is None:
+                entry = self.fetch(url)
+                encoding = get_encoding(entry.get('content-type'))
+                text = self.texts[url] = self.read(url).decode(encoding, 'replace')
+            return text
+
+    @contextlib.contextmanager
+    def stream(self, url):
+        """Provides the encoding and the blocks of the body as they are received.
+        The body is stored only if it is read to the end, and served from the
+        store if the entry is fresh or not modified.
+        """
+        with self.getlock(url):
+            entry = self.load(url)
+            if entry and 'digest' not in entry:
+                entry = None
+            response = None
+            if not self.offline and not (entry and url in self.fresh):
+                start = time.time()
+                response = self.session.get(url, headers=conditional_headers(entry), stream=True)
+                if entry and response.status_code == 304:
+                    response.close()
+                    entry['etag'] = response.headers.get('etag', entry.get('etag'))
+                    self.save_entry(url, entry)
+                    self.fresh.add(url)
+                    response = None
+            if response is None:
+                if not entry:
+                    raise NotInCache(url)
+                with open(self.getblob(entry), 'rb') as file:
+                    yield get_encoding(entry.get('content-type')), read_blocks(file, 0x10000)
+                return
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'blobs'))
+            received = []
+            def receive_blocks(file):
+                for block in response.raw.stream(0x10000, decode_content=True):
+                    file.write(block)
+                    yield block
+                received.append(True)
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    response.raise_for_status()
+                    yield get_encoding(response.headers.get('content-type')), receive_blocks(file)
+            finally:
+                response.close()
+                Trace.add(url, 'download', start, time.time(), host=get_host(url), \
+                    bytes=response.raw.tell(), complete=bool(received))
+                if not received:
+                    os.remove(tmp_path)
+            if received:
+                self.put_file(url, tmp_path, **get_validators(response, 'content-type', 'link'))
+                self.fresh.add(url)
+
+    def search(self, url, pattern, first=False):
+        """Returns the groups of the matches of a pattern in the page, searched
+        while it is received. With first, the page is closed on the first match.
+        The matches are kept for the run, so a page is not searched twice for the
+        same pattern, unless all the matches are requested after the first one.
+        """
+        with self.getlock(url):
+            matches, complete = self.matches.get((url, pattern), ([], False))
+            if not complete and not (first and matches):
+                matches, complete = [], True
+                with self.stream(url) as (encoding, blocks):
+                    for m in search_blocks(blocks, pattern, encoding):
+                        matches.append((m.group(0),) + m.groups())
+                        if first:
+                            complete = False
+                            break
+                self.matches[(url, pattern)] = (matches, complete)
+            return matches
+
+    def copy(self, url, dest):
+        entry = self.fetch(url)
+        with Pipeline.default.stage('write'):
+            shutil.copyfile(self.getblob(entry), dest)
+
+    def evict(self):
+        blobs, total = [], 0
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.directory, 'blobs')):
+            for filename in filenames:
+                stat = os.stat(os.path.join(dirpath, filename))
+                blobs.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, filename)))
+                total += stat.st_size
+        for mtime, size, path in sorted(blobs):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+def conditional_headers(entry):
+    headers = {}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('last-modified'):
+        headers['If-Modified-Since'] = entry['last-modified']
+    return headers
+
+def get_rate_limit_delay(response):
+    """Returns the seconds to wait if the response is a rate limit error"""
+    if response.status_code not in (403, 429):
+        return None
+    headers = response.headers
+    if headers.get('retry-after', '').isdigit():
+        return int(headers['retry-after'])
+    if headers.get('x-ratelimit-remaining') == '0' and headers.get('x-ratelimit-reset', '').isdigit():
+        return max(0, int(headers['x-ratelimit-reset']) - time.time())
+    return None
+
+def get_validators(response, *names):
+    return dict((k, response.headers.get(k)) for k in ('etag', 'last-modified') + names)
+
+def receive(response, file):
+    """Copies the body of a response with a block size adapted to the throughput"""
+    raw, size = response.raw, 0x10000
+    while not raw.closed:
+        start = time.time()
+        block = raw.read(size, decode_content=True)
+        if block:
+            file.write(block)
+        elapsed = time.time() - start
+        if elapsed < 0.05 and size < 0x400000:
+            size *= 2
+        elif elapsed > 0.5 and size > 0x10000:
+            size /= 2
+
+def read_blocks(file, size=0x100000):
+    return iter(lambda: file.read(size), '')
+
+def get_encoding(content_type):
+    return requests.utils.get_encoding_from_headers({'content-type': content_type or ''}) or 'utf-8'
+
+def search_blocks(blocks, pattern, encoding='utf-8', overlap=0x1000):
+    """Yields the matches of a pattern in a text received by blocks.
+    The blocks are decoded incrementally and the last overlap characters are
+    kept in the window, so a match spanning two blocks is yielded once the
+    characters following it are received.
+    """
+    p = re.compile(pattern)
+    decoder = codecs.getincrementaldecoder(encoding)('replace')
+    text, pos, final = u'', 0, False
+    blocks = iter(blocks)
+    while not final:
+        block = next(blocks, None)
+        final = block is None
+        text += decoder.decode(block or '', final)
+        limit = len(text) if final else len(text) - overlap
+        for m in p.finditer(text, pos):
+            if m.end() > limit:
+                break  #could be longer with the next block
+            yield m
+            pos = max(m.end(), m.start() + 1)
+        cut = min(pos, max(0, len(text) - overlap))
+        text, pos = text[cut:], pos - cut
+
+def check_cancelled():
+    """Raises TaskCancelled if the task run by the current thread was cancelled"""
+    task = getattr(TaskExecutor.local, 'task', None)
+    if task and task.cancelled:
+        raise TaskCancelled(task.name)
+
+class TaskCancelled(Exception):
+
+    def __init__(self, name):
+        self.__data__ = (name,)
+
+    def __str__(self):
+        return 'Task %s() was cancelled' % self.__data__
+
+class PipelineError(Exception):
+
+    def __init__(self, name, reached):
+        self.__data__ = (name, reached)
+
+    def __str__(self):
+        return 'Stage %s entered after stage %s' % self.__data__
 
 class PatternNotFound(Exception):
 
@@ -424,6 +1459,14 @@ class PatternNotFound(Exception):
     def __str__(self):
         return 'Pattern "%s" not found in %s' % self.__data__
 
+class NotInCache(Exception):
+
+    def __init__(self, url):
+        self.__data__ = (url,)
+
+    def __str__(self):
+        return 'Offline: "%s" is not in the cache' % self.__data__
+
 def Log(message):
     with Logger.lock:
         print message
@@ -452,4 +1495,4 @@ class Logger:
 
 if __name__ == '__main__':
     with Logger() as log:
-        main()
+        main(sys.argv[1:])
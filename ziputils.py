@@ -0,0 +1,43 @@
+"""Zip archives copied member by member without recompression
+Shared by update-references.py, rebuild_exel_files.py and FirefoxAddons/build-addins.py.
+"""
+
+import re, zipfile, struct, copy
+
+def rewrite_zip(file_in, file_out, skip=None, edits=None):
+    """Copies a zip archive without recompressing the members.
+    The members matching skip are dropped and the ones matching a pattern in
+    edits are transformed by its function and compressed as they were.
+    """
+    edits = edits or {}
+    with zipfile.ZipFile(file_in, 'r') as zip_in, zipfile.ZipFile(file_out, 'w') as zip_out:
+        for info in zip_in.infolist():
+            if skip and re.search(skip, info.filename):
+                continue
+            edit = next((fn for pattern, fn in edits.items() if re.search(pattern, info.filename)), None)
+            if edit:
+                zinfo = copy.copy(info)
+                zinfo.flag_bits &= ~0x08
+                zip_out.writestr(zinfo, edit(zip_in.read(info)), compress_type=info.compress_type)
+            else:
+                copy_member(zip_in, info, zip_out)
+
+def copy_member(zip_in, info, zip_out):
+    """Copies a member and its compressed data from an archive to another without decompressing it"""
+    zip_in.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, zip_in.fp.read(zipfile.sizeFileHeader))
+    zip_in.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    zinfo = copy.copy(info)
+    zinfo.flag_bits &= ~0x08  #sizes and crc are in the local header, no data descriptor
+    zinfo.header_offset = zip_out.fp.tell()
+    zip_out.fp.write(zinfo.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        block = zip_in.fp.read(min(remaining, 1 << 16))
+        if not block:
+            raise zipfile.BadZipfile('Truncated member: ' + info.filename)
+        zip_out.fp.write(block)
+        remaining -= len(block)
+    zip_out.filelist.append(zinfo)
+    zip_out.NameToInfo[zinfo.filename] = zinfo
+    zip_out._didModify = True